@@ -0,0 +1,84 @@
+"""Moves old raw_payload to the compressed archive and shrinks payment_bot.db.
+
+Usage: python archive.py [--convert]   (one pass; --convert first switches an older
+       database to incremental auto-vacuum, which rewrites the file once)
+"""
+import asyncio
+import logging
+import sys
+
+import config
+import database
+from database import run_db, archive_payloads, incremental_vacuum
+
+logger = logging.getLogger(__name__)
+
+
+class PayloadArchiver:
+    """Every ``interval`` seconds archives raw_payload of performed payments older than ``after_days``.
+
+    Works in batches of ``batch_size`` rows, each its own pair of short DB calls, so the
+    DB worker is never held for long; the free pages are then given back with an
+    incremental vacuum of at most ``vacuum_pages`` pages per call.
+    """
+
+    def __init__(self, *, after_days: float = 30.0, interval: float = 6 * 3600, batch_size: int = 500,
+                 vacuum_pages: int = 1000):
+        self.after_days = after_days
+        self.interval = interval
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+        self._task: asyncio.Task | None = None
+
+    async def run_once(self) -> int:
+        archived = 0
+        while True:
+            moved = await run_db(archive_payloads, self.after_days, self.batch_size)
+            archived += moved
+            if moved < self.batch_size:
+                break
+        left = None
+        while left != 0:
+            previous, left = left, await run_db(incremental_vacuum, self.vacuum_pages)
+            if left == previous:
+                # auto_vacuum is not INCREMENTAL on this file: nothing to give back
+                break
+        if archived:
+            logger.warning("archived raw_payload of %d payments", archived)
+        return archived
+
+    async def _loop(self) -> None:
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("payload archiving failed: %s", e)
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+async def _main(convert: bool) -> None:
+    await run_db(database.init_db)
+    if convert and await run_db(database.enable_incremental_vacuum):
+        print("database switched to incremental auto-vacuum")
+    archiver = PayloadArchiver(after_days=config.ARCHIVE_AFTER_DAYS, batch_size=config.ARCHIVE_BATCH_SIZE)
+    print(f"archived raw_payload of {await archiver.run_once()} payments")
+    await database.close_db()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main("--convert" in sys.argv[1:]))
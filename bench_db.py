@@ -0,0 +1,191 @@
+"""Micro-benchmark for the payments write path in database.py.
+
+Runs the same workload (save a payment, then set it to "performed") against a fresh
+temporary database in four modes:
+
+  * before  - the original write path, reproduced below: a new connection per call in
+              sqlite's default rollback-journal mode, SELECT-then-INSERT/UPDATE in an
+              explicit transaction, and the original schema;
+  * after   - database.save_payment / update_payment_status on the tuned, long-lived
+              connection from database.get_conn();
+  * async   - the same, driven from 50 concurrent payment tasks through the DB worker
+              thread, one commit per status update;
+  * batched - the same, with status updates group-committed by database.status_writer.
+
+Usage: python bench_db.py [payments]
+"""
+import asyncio
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+from decimal import Decimal
+
+import database
+
+
+# --- "before": database.py's write path as it was before connections were reused ---
+
+def _baseline_conn(path: str) -> sqlite3.Connection:
+    return sqlite3.connect(path, isolation_level=None, detect_types=sqlite3.PARSE_DECLTYPES)
+
+
+def _baseline_init(path: str) -> None:
+    conn = _baseline_conn(path)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS payments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            provider TEXT NOT NULL,
+            provider_txn_id TEXT NOT NULL,
+            callsign TEXT NOT NULL,
+            driver_profile_id TEXT DEFAULT '',
+            amount TEXT NOT NULL,
+            currency TEXT DEFAULT 'UZS',
+            category_id TEXT NOT NULL,
+            status TEXT DEFAULT 'created',
+            raw_payload TEXT,
+            park_group_id TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            performed_at TEXT,
+            UNIQUE(provider, provider_txn_id)
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_provider_txn_id ON payments (provider, provider_txn_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_callsign ON payments (callsign)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_status ON payments (status)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_park_group ON payments (park_group_id)")
+    conn.close()
+
+
+def _baseline_save(path: str, provider, provider_txn_id, callsign, amount, category_id, raw_payload,
+                   park_group_id) -> int:
+    conn = _baseline_conn(path)
+    cur = conn.cursor()
+    try:
+        cur.execute("BEGIN")
+        cur.execute("SELECT id, status FROM payments WHERE provider = ? AND provider_txn_id = ?",
+                    (provider, provider_txn_id))
+        assert cur.fetchone() is None
+        cur.execute("""
+            INSERT INTO payments
+            (provider, provider_txn_id, callsign, amount, currency, category_id,
+             status, raw_payload, driver_profile_id, performed_at, park_group_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (provider, provider_txn_id, callsign, str(amount), "UZS", category_id, "created",
+              json.dumps(raw_payload, ensure_ascii=False), "", None, park_group_id))
+        payment_id = cur.lastrowid
+        cur.execute("COMMIT")
+        cur.execute("SELECT * FROM payments WHERE id = ?", (payment_id,))
+        cur.fetchone()
+        return payment_id
+    finally:
+        conn.close()
+
+
+def _baseline_update(path: str, payment_id: int, status: str, driver_profile_id: str) -> None:
+    conn = _baseline_conn(path)
+    try:
+        performed_at = datetime.utcnow().isoformat(timespec="seconds")
+        conn.execute("UPDATE payments SET status = ?, driver_profile_id = ?, performed_at = ? WHERE id = ?",
+                     (status, driver_profile_id, performed_at, payment_id))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _run_before(path: str, count: int) -> float:
+    _baseline_init(path)
+    started = time.perf_counter()
+    for i in range(count):
+        payment_id = _baseline_save(
+            path,
+            provider="payme",
+            provider_txn_id=f"bench-{i}",
+            callsign=f"CS{i % 500}",
+            amount=Decimal("150000.00"),
+            category_id="partner_service_manual",
+            raw_payload={"raw_text": "🇺🇿 150,000.00 сум\n🧾 %d" % i, "group_id": "-100"},
+            park_group_id="Bench_payme",
+        )
+        _baseline_update(path, payment_id, "performed", f"D{i % 500}")
+    return count / (time.perf_counter() - started)
+
+
+def _run(count: int) -> float:
+    database.init_db()
+    started = time.perf_counter()
+    for i in range(count):
+        ok, payment, _ = database.save_payment(
+            provider="payme",
+            provider_txn_id=f"bench-{i}",
+            callsign=f"CS{i % 500}",
+            amount=Decimal("150000.00"),
+            category_id="partner_service_manual",
+            raw_payload={"raw_text": "🇺🇿 150,000.00 сум\n🧾 %d" % i, "group_id": "-100"},
+            park_group_id="Bench_payme",
+        )
+        assert ok, payment
+        database.update_payment_status(payment["id"], "performed", driver_profile_id=f"D{i % 500}")
+    return count / (time.perf_counter() - started)
+
+
+async def _run_async(count: int, batched: bool, concurrency: int = 50) -> float:
+    await database.run_db(database.init_db)
+    if batched:
+        database.status_writer.start()
+    slots = asyncio.Semaphore(concurrency)
+
+    async def one(i: int) -> None:
+        async with slots:
+            ok, payment, _ = await database.save_payment_async(
+                provider="payme",
+                provider_txn_id=f"bench-{i}",
+                callsign=f"CS{i % 500}",
+                amount=Decimal("150000.00"),
+                category_id="partner_service_manual",
+                raw_payload={"raw_text": "🇺🇿 150,000.00 сум\n🧾 %d" % i, "group_id": "-100"},
+                park_group_id="Bench_payme",
+            )
+            assert ok, payment
+            await database.update_payment_status_async(payment["id"], "performed", driver_profile_id=f"D{i % 500}")
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(count)))
+    await database.status_writer.stop()
+    elapsed = time.perf_counter() - started
+    await database.run_db(database.close_conn)
+    return count / elapsed
+
+
+async def _run_both(tmp: str, count: int) -> tuple:
+    database.DB_NAME = os.path.join(tmp, "async.db")
+    unbatched = await _run_async(count, batched=False)
+    database.DB_NAME = os.path.join(tmp, "batched.db")
+    batched = await _run_async(count, batched=True)
+    await database.close_db()
+    return unbatched, batched
+
+
+def main(count: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        before = _run_before(os.path.join(tmp, "before.db"), count)
+
+        database.DB_NAME = os.path.join(tmp, "after.db")
+        after = _run(count)
+        database.close_conn()
+
+        unbatched, batched = asyncio.run(_run_both(tmp, count))
+
+    print(f"payments: {count}")
+    print(f"before (connection per call, rollback journal): {before:,.0f} payments/sec")
+    print(f"after  (long-lived connection, WAL):            {after:,.0f} payments/sec")
+    print(f"async   (worker thread, commit per update):     {unbatched:,.0f} payments/sec")
+    print(f"batched (worker thread, group-committed):       {batched:,.0f} payments/sec")
+    print(f"connection reuse + WAL: {after / before:.1f}x, group commit: {batched / unbatched:.1f}x")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
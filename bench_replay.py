@@ -0,0 +1,308 @@
+"""End-to-end replay benchmark for the payment pipeline.
+
+Feeds a stream of Payme/Click group messages into telegram_api.handle_message while
+the Fleet API and the Bot API are served by local fakes, so no money moves and no
+Telegram message is sent:
+
+  * fake Fleet API - driver-profiles/list (paged and by callsign) and
+    driver-profiles/transactions, over a pool of ``--drivers`` drivers;
+  * fake Bot API   - sendMessage.
+
+Both fakes add ``--*-latency`` milliseconds (+-50% jitter) per request and answer 503
+for ``--*-error-rate`` of them. The stream is either synthetic (``--messages`` of them,
+a share cancelled or re-delivered) or replayed from ``--replay FILE``, one JSON object
+per line: ``{"provider": "payme" | "click", "text": "..."}``.
+
+Reports throughput, p50/p95/p99 message-to-outcome latency, DB commits per second
+and how often each fake endpoint was called. Tuning env variables (TOPUP_BATCH_WINDOW,
+YANDEX_PARK_CONCURRENCY, ...) apply as usual, so a change can be compared against the
+baseline by running this twice.
+
+Usage: python bench_replay.py [--messages N] [--rate MSGS_PER_SEC] [--replay FILE] ...
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+from aiohttp import web
+
+PAYME_GROUP = "-1001"
+CLICK_GROUP = "-1002"
+BOT_TOKEN = "bench:token"
+
+# DB writes that end in a commit, as labelled by run_db on metrics.DB_SECONDS
+WRITE_OPS = ("save_payment", "update_payment_status", "update_payment_statuses", "assign_idempotency_token",
+             "save_drivers", "invalidate_driver", "delete_drivers")
+
+
+def _driver(i: int) -> dict:
+    return {
+        "driver_profile": {"id": f"driver-{i}", "first_name": "Bench", "last_name": str(i)},
+        "car": {"callsign": str(10000 + i)},
+        "accounts": [{"id": f"acc-{i}", "balance": "0", "currency": "UZS"}],
+    }
+
+
+class FakeAPIs:
+    """aiohttp app standing in for the Fleet API and the Bot API on one local port."""
+
+    def __init__(self, drivers: int, fleet_latency: float, fleet_error_rate: float,
+                 bot_latency: float, bot_error_rate: float):
+        self.drivers = [_driver(i) for i in range(drivers)]
+        self.by_callsign = {d["car"]["callsign"]: d for d in self.drivers}
+        self.fleet_latency = fleet_latency / 1000
+        self.fleet_error_rate = fleet_error_rate
+        self.bot_latency = bot_latency / 1000
+        self.bot_error_rate = bot_error_rate
+        self.calls = Counter()
+        self.topped_up = Counter()
+
+        self.app = web.Application()
+        self.app.router.add_post("/v1/parks/driver-profiles/list", self.driver_profiles)
+        self.app.router.add_post("/v2/parks/driver-profiles/transactions", self.transactions)
+        self.app.router.add_post("/bot{token}/sendMessage", self.send_message)
+        self._runner: web.AppRunner | None = None
+        self.base_url = ""
+
+    async def start(self) -> None:
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://127.0.0.1:{port}"
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def _delay(self, latency: float, error_rate: float):
+        if latency:
+            await asyncio.sleep(random.uniform(0.5 * latency, 1.5 * latency))
+        if error_rate and random.random() < error_rate:
+            return web.json_response({"code": "unavailable"}, status=503)
+        return None
+
+    async def driver_profiles(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        query = body.get("query") or {}
+        self.calls["fleet list (lookup)" if query.get("text") else "fleet list (page)"] += 1
+        failure = await self._delay(self.fleet_latency, self.fleet_error_rate)
+        if failure:
+            return failure
+        if query.get("text"):
+            driver = self.by_callsign.get(query["text"].strip())
+            return web.json_response({"driver_profiles": [driver] if driver else [], "total": int(bool(driver))})
+        offset, limit = body.get("offset", 0), body.get("limit", 1000)
+        page = self.drivers[offset:offset + limit]
+        return web.json_response({"driver_profiles": page, "total": len(self.drivers),
+                                  "offset": offset, "limit": limit})
+
+    async def transactions(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        self.calls["fleet transactions"] += 1
+        failure = await self._delay(self.fleet_latency, self.fleet_error_rate)
+        if failure:
+            return failure
+        self.topped_up[request.headers.get("X-Idempotency-Token")] += 1
+        return web.json_response({"amount": body.get("amount"), "driver_profile_id": body.get("driver_profile_id")})
+
+    async def send_message(self, request: web.Request) -> web.Response:
+        self.calls["bot sendMessage"] += 1
+        failure = await self._delay(self.bot_latency, self.bot_error_rate)
+        if failure:
+            return failure
+        return web.json_response({"ok": True, "result": {"message_id": self.calls["bot sendMessage"]}})
+
+
+def synthetic_stream(count: int, drivers: int, cancelled: float, redelivered: float, seed: int) -> list:
+    """``(group_id, text)`` pairs: alternating Payme/Click, a fifth of them from the busiest 5% of drivers."""
+    rnd = random.Random(seed)
+    busy = max(1, drivers // 20)
+    messages = []
+    for i in range(count):
+        callsign = 10000 + (rnd.randrange(busy) if rnd.random() < 0.2 else rnd.randrange(drivers))
+        amount = rnd.choice((10_000, 25_000, 50_000, 100_000, 150_000, 300_000))
+        ok = rnd.random() >= cancelled
+        if i % 2 == 0:
+            status = "✅ Успешно оплачен" if ok else "❌ Платёж отменён"
+            text = (f"{status}\n🆔 {i:024x}\n🧾 {4_000_000_000 + i}\n🇺🇿 {amount:,}.00 сум\n"
+                    f"➡️ Параметры оплаты:\n🔸 Позывной водителя: {callsign}")
+            messages.append((PAYME_GROUP, text))
+        else:
+            status = "✅ Успешно подтвержден" if ok else "⏳ Ожидает подтверждения"
+            text = f"{status}\n🧾 {2_900_000_000 + i}\n🇺🇿 {amount:,} сум\n🔸 ID водителя: {callsign}".replace(",", " ")
+            messages.append((CLICK_GROUP, text))
+        if rnd.random() < redelivered:
+            messages.append(messages[-1])
+    return messages
+
+
+def recorded_stream(path: str) -> list:
+    messages = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                messages.append((CLICK_GROUP if item.get("provider") == "click" else PAYME_GROUP, item["text"]))
+    return messages
+
+
+def _configure_env(base_url: str, tmp: str) -> None:
+    env = {
+        "PARK1_NAME": "Bench_payme", "PARK1_PROVIDER": "payme", "PARK1_TELEGRAM_GROUPS": PAYME_GROUP,
+        "PARK2_NAME": "Bench_click", "PARK2_PROVIDER": "click", "PARK2_TELEGRAM_GROUPS": CLICK_GROUP,
+        "PROVIDER_PAYME": "partner_service_manual_payme", "PROVIDER_CLICK": "partner_service_manual_click",
+        "TELEGRAM_BOT_TOKEN": BOT_TOKEN, "METRICS_PORT": "0",
+        "YANDEX_API_BASE": base_url, "TELEGRAM_API_BASE": base_url,
+        "YANDEX_HTTP2": "0", "NOTIFY_CHAT_INTERVAL": "0", "NOTIFY_GLOBAL_RATE": "0",
+    }
+    for n in (1, 2):
+        env.update({f"PARK{n}_API_KEY": "bench", f"PARK{n}_CLID": "bench", f"PARK{n}_PARK_ID": "bench-park",
+                    f"PARK{n}_NOTIFICATION_CHAT_ID": "-100999"})
+    for key, value in env.items():
+        os.environ.setdefault(key, value)
+    os.chdir(tmp)
+
+
+def _percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+async def run(args) -> str:
+    fakes = FakeAPIs(args.drivers, args.fleet_latency, args.fleet_error_rate, args.bot_latency, args.bot_error_rate)
+    await fakes.start()
+    tmp = tempfile.mkdtemp(prefix="bench_replay_")
+    _configure_env(fakes.base_url, tmp)
+
+    # Imported only now: config reads the environment and the DB is created at import time
+    import database
+    database.DB_NAME = os.path.join(tmp, "replay.db")
+    import config
+    import metrics
+    import telegram_api
+
+    if args.replay:
+        messages = recorded_stream(args.replay)
+    else:
+        messages = synthetic_stream(args.messages, args.drivers, args.cancelled, args.redelivered, args.seed)
+
+    latencies = []
+    outcomes = Counter()
+    injected_at = {}
+    process = telegram_api.save_payment_and_topup
+
+    async def timed_process(**kwargs):
+        result = await process(**kwargs)
+        latencies.append(time.perf_counter() - injected_at[kwargs["provider_txn_id"]])
+        outcomes[result[2]] += 1
+        return result
+
+    telegram_api.save_payment_and_topup = timed_process
+    persist = telegram_api.save_payment_for_recovery
+
+    async def counted_persist(**kwargs):
+        result = await persist(**kwargs)
+        outcomes["saved for recovery"] += 1
+        return result
+
+    telegram_api.save_payment_for_recovery = counted_persist
+
+    telegram_api.dispatcher.start()
+    database.status_writer.start()
+    await config.start_parks(config.PARKS)
+    if not args.cold:
+        await asyncio.gather(*(index.build() for index in config.driver_indexes(config.PARKS)))
+    telegram_api.payment_queue.start()
+    telegram_api.recovery.start()
+
+    expected = 0
+    started = time.perf_counter()
+    for i, (group_id, text) in enumerate(messages):
+        if args.rate:
+            delay = started + i / args.rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        parsed = telegram_api.parse_message(text)
+        if parsed.success:
+            expected += 1
+            injected_at.setdefault(parsed.provider_txn_id, time.perf_counter())
+        message = SimpleNamespace(id=i + 1, text=text, caption=None,
+                                  chat=SimpleNamespace(id=int(group_id), title="bench"))
+        await telegram_api.handle_message(None, message)
+
+    while len(latencies) + outcomes["saved for recovery"] < expected:
+        await asyncio.sleep(0.01)
+    # Payments shed past the intake high watermark are topped up by the recovery worker
+    while outcomes["saved for recovery"] and await database.run_db(database.count_payments_by_status, "created"):
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - started
+    commits = sum(metrics.DB_SECONDS.count(op=op) for op in WRITE_OPS)
+
+    await telegram_api.payment_queue.stop()
+    await telegram_api.recovery.stop()
+    await telegram_api.topup_scheduler.stop()
+    await database.status_writer.stop()
+    await telegram_api.dispatcher.stop(timeout=args.drain)
+    await config.close_parks(config.PARKS)
+    await database.close_db()
+    await fakes.stop()
+
+    double = sum(1 for count in fakes.topped_up.values() if count > 1)
+    lines = [
+        f"messages: {len(messages)}, payments: {expected}, drivers: {args.drivers}",
+        f"fleet latency {args.fleet_latency:g} ms / errors {args.fleet_error_rate:.0%}, "
+        f"bot latency {args.bot_latency:g} ms / errors {args.bot_error_rate:.0%}",
+        f"throughput: {expected / elapsed:,.1f} payments/sec over {elapsed:.2f} s",
+        f"latency (queued payments) p50 {_percentile(latencies, 50) * 1000:,.1f} ms, p95 {_percentile(latencies, 95) * 1000:,.1f} ms, "
+        f"p99 {_percentile(latencies, 99) * 1000:,.1f} ms",
+        f"db commits: {commits} ({commits / elapsed:,.1f}/sec)",
+    ]
+    lines += [f"{name}: {count}" for name, count in sorted(fakes.calls.items())]
+    lines.append("outcomes: " + ", ".join(f"{msg}={count}" for msg, count in outcomes.most_common()))
+    if double:
+        lines.append(f"idempotency tokens topped up more than once: {double}")
+    return "\n".join(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--messages", type=int, default=2000, help="synthetic messages to send")
+    parser.add_argument("--replay", help="JSON-lines file of recorded messages instead of synthetic ones")
+    parser.add_argument("--rate", type=float, default=0, help="messages per second, 0 = as fast as possible")
+    parser.add_argument("--drivers", type=int, default=500)
+    parser.add_argument("--cancelled", type=float, default=0.05, help="share of cancelled/pending messages")
+    parser.add_argument("--redelivered", type=float, default=0.01, help="share of messages delivered twice")
+    parser.add_argument("--fleet-latency", type=float, default=80, help="ms per Fleet API request")
+    parser.add_argument("--fleet-error-rate", type=float, default=0.0)
+    parser.add_argument("--bot-latency", type=float, default=50, help="ms per Bot API request")
+    parser.add_argument("--bot-error-rate", type=float, default=0.0)
+    parser.add_argument("--cold", action="store_true", help="skip the driver index build, every lookup goes live")
+    parser.add_argument("--drain", type=float, default=2.0, help="seconds to let notifications drain at the end")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--verbose", action="store_true", help="keep the bot's own output")
+    args = parser.parse_args()
+    if args.verbose:
+        report = asyncio.run(run(args))
+    else:
+        # The bot prints and logs a line per message and per retry; keep only the report
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            report = asyncio.run(run(args))
+    print(report)
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    main()
@@ -0,0 +1,98 @@
+"""Benchmark for reconciliation reports over a large payments table.
+
+Fills a temporary database (schema and migrations from database.init_db) with
+synthetic payments spread over a year across several parks and categories, then
+times the same per-park / all-park totals two ways:
+
+  * before - what a report had to do before amount_tiyin and the report indexes:
+    scan the table and SUM(CAST(amount AS REAL)) (forced with NOT INDEXED);
+  * after  - database.payment_totals(), answered from a covering index.
+
+Usage: python bench_reports.py [payments]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import database
+
+PARKS = [f"Park{i}_{provider}" for i in range(1, 11) for provider in ("payme", "click")]
+CATEGORIES = ["partner_service_manual_payme", "partner_service_manual_click"]
+START = datetime(2025, 1, 1)
+
+
+def _rows(count: int):
+    rnd = random.Random(1)
+    for i in range(count):
+        park = rnd.choice(PARKS)
+        created = START + timedelta(seconds=rnd.randrange(365 * 86400))
+        status = "performed" if rnd.random() < 0.95 else rnd.choice(("failed", "created"))
+        amount_tiyin = rnd.choice((10_000, 25_000, 50_000, 150_000, 300_000)) * 100
+        yield (
+            park.rsplit("_", 1)[1], f"bench-{i}", str(1000 + rnd.randrange(5000)),
+            f"{amount_tiyin / 100:.2f}", amount_tiyin, CATEGORIES[park.endswith("click")], status,
+            park, created.isoformat(sep=" "),
+            (created + timedelta(seconds=2)).isoformat() if status == "performed" else None,
+        )
+
+
+def _fill(count: int) -> float:
+    database.init_db()
+    started = time.perf_counter()
+    with database.transaction() as conn:
+        conn.executemany("""
+            INSERT INTO payments (provider, provider_txn_id, callsign, amount, amount_tiyin, category_id, status,
+                                  park_group_id, created_at, performed_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, _rows(count))
+    database.get_conn().execute("ANALYZE")
+    return time.perf_counter() - started
+
+
+def _before(start: str, end: str, park_group_id: str = None) -> list:
+    where = "status = 'performed' AND performed_at >= ? AND performed_at < ?"
+    params = [start, end]
+    if park_group_id is not None:
+        where = "park_group_id = ? AND " + where
+        params.insert(0, park_group_id)
+    return database.get_conn().execute(f"""
+        SELECT park_group_id, category_id, COUNT(*), SUM(CAST(amount AS REAL))
+        FROM payments NOT INDEXED
+        WHERE {where}
+        GROUP BY park_group_id, category_id
+    """, params).fetchall()
+
+
+def _timed(func, *args, repeat: int = 3, **kwargs) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(*args, **kwargs)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main(count: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_NAME = os.path.join(tmp, "reports.db")
+        fill = _fill(count)
+        cases = [
+            ("one park, one day", ("2025-06-01", "2025-06-02", PARKS[0])),
+            ("one park, one month", ("2025-06-01", "2025-07-01", PARKS[0])),
+            ("all parks, one day", ("2025-06-01", "2025-06-02", None)),
+            ("all parks, one month", ("2025-06-01", "2025-07-01", None)),
+        ]
+        print(f"payments: {count:,} (filled in {fill:.1f} s)")
+        for name, (start, end, park) in cases:
+            before = _timed(_before, start, end, park)
+            after = _timed(database.payment_totals, start, end, park)
+            print(f"{name:<22} before {before * 1000:9.1f} ms   after {after * 1000:8.1f} ms   "
+                  f"{before / after:7.1f}x")
+        database.close_conn()
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 3_000_000)
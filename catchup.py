@@ -0,0 +1,183 @@
+import asyncio
+import logging
+
+from database import run_db, load_checkpoints, save_checkpoints, existing_txn_ids
+from parser import parse_message
+
+logger = logging.getLogger(__name__)
+
+
+class GroupCheckpoints:
+    """Per-group id of the last message up to which everything has been handled.
+
+    Payment messages are ``begin()``-ed on intake and ``done()`` once their row is saved;
+    the checkpoint of a group stays below its oldest unfinished payment, so a crash never
+    moves it past a message whose payment was only queued in memory. Other messages just
+    advance it via ``seen()``. A message may be begun more than once (catch-up holds it
+    until it is submitted, the queue until it is saved); it is finished once every
+    ``begin()`` has its ``done()``. Checkpoints are written every ``flush_interval``
+    seconds and on ``stop()``.
+
+    ``last()`` is the checkpoint as ``load()`` found it, whatever has been flushed since;
+    ``hold_start()`` keeps groups at that checkpoint until ``release_start()``, so live
+    messages can't move a group past payments its catch-up hasn't replayed yet.
+    """
+
+    def __init__(self, flush_interval: float = 5.0):
+        self.flush_interval = flush_interval
+        self._stored: dict[str, int] = {}
+        self._seen: dict[str, int] = {}
+        self._pending: dict[str, dict[int, int]] = {}
+        self._start: dict[str, int] = {}
+        self._held: dict[str, int] = {}
+        self._task: asyncio.Task | None = None
+
+    async def load(self) -> None:
+        self._stored = await run_db(load_checkpoints)
+        self._start = dict(self._stored)
+
+    def last(self, group_id: str) -> int | None:
+        return self._start.get(str(group_id))
+
+    def hold_start(self, group_ids) -> None:
+        for group_id in map(str, group_ids):
+            if group_id in self._start:
+                self._held[group_id] = self._start[group_id]
+
+    def release_start(self, group_id: str) -> None:
+        self._held.pop(str(group_id), None)
+
+    def seen(self, group_id: str, message_id: int) -> None:
+        group_id = str(group_id)
+        if message_id > self._seen.get(group_id, 0):
+            self._seen[group_id] = message_id
+
+    def begin(self, group_id: str, message_id: int) -> None:
+        self.seen(group_id, message_id)
+        pending = self._pending.setdefault(str(group_id), {})
+        pending[message_id] = pending.get(message_id, 0) + 1
+
+    def done(self, group_id: str, message_id: int) -> None:
+        pending = self._pending.get(str(group_id), {})
+        count = pending.pop(message_id, 0)
+        if count > 1:
+            pending[message_id] = count - 1
+
+    def safe(self, group_id: str) -> int:
+        pending = self._pending.get(group_id)
+        safe = min(pending) - 1 if pending else self._seen.get(group_id, 0)
+        held = self._held.get(group_id)
+        return safe if held is None else min(safe, held)
+
+    async def flush(self) -> None:
+        changed = {}
+        for group_id in self._seen:
+            safe = self.safe(group_id)
+            if safe > self._stored.get(group_id, 0):
+                changed[group_id] = safe
+        if changed:
+            await run_db(save_checkpoints, changed)
+            self._stored.update(changed)
+
+    async def _loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("checkpoint flush failed: %s", e)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+async def _missed_messages(client, chat_id, last_id: int, limit: int) -> list:
+    """Messages newer than ``last_id``, oldest first (get_chat_history walks newest first)."""
+    messages = []
+    async for message in client.get_chat_history(chat_id, limit=limit):
+        if message.id <= last_id:
+            break
+        messages.append(message)
+    messages.reverse()
+    return messages
+
+
+async def catch_up_group(client, chat_id, group_id: str, park, checkpoints: GroupCheckpoints, submit, *,
+                         limit: int = 5000, rate: float = 20.0) -> int:
+    """Feed payments posted to one group while the bot was down into ``submit``; returns how many.
+
+    A group without a checkpoint (first run) is not replayed: its newest message becomes
+    the starting point. Txn ids that already have a payment row are skipped with one
+    set query per group. The group's start checkpoint is released once every missed
+    payment has been handed to ``submit``; on failure it stays held for the run.
+    """
+    last_id = checkpoints.last(group_id)
+    if last_id is None:
+        async for message in client.get_chat_history(chat_id, limit=1):
+            checkpoints.seen(group_id, message.id)
+        return 0
+
+    messages = await _missed_messages(client, chat_id, last_id, limit)
+    if not messages:
+        checkpoints.release_start(group_id)
+        return 0
+    if len(messages) >= limit:
+        logger.warning("catch-up for group %s stopped at %d messages; older ones are not replayed",
+                       group_id, limit)
+
+    # Every candidate is held before the first await: submits are rate-limited, and until
+    # one is handed over, other messages (live ones too) must not move the checkpoint past it
+    candidates = []
+    for message in messages:
+        parsed = parse_message(message.text or message.caption or "")
+        if parsed.success and parsed.provider_txn_id:
+            candidates.append((message, parsed))
+            checkpoints.begin(group_id, message.id)
+        else:
+            checkpoints.seen(group_id, message.id)
+
+    # If this fails part-way, the candidates not handed over stay held for the rest of the
+    # run, so the stored checkpoint stays below them and the next start replays them
+    known = await run_db(existing_txn_ids, park.provider, [parsed.provider_txn_id for _, parsed in candidates])
+    submitted = 0
+    for message, parsed in candidates:
+        if parsed.provider_txn_id in known:
+            checkpoints.done(group_id, message.id)
+            continue
+        known.add(parsed.provider_txn_id)
+        await submit(park, message, parsed)
+        checkpoints.done(group_id, message.id)
+        submitted += 1
+        if rate > 0:
+            await asyncio.sleep(1.0 / rate)
+
+    checkpoints.release_start(group_id)
+    logger.warning("catch-up for group %s (%s): %d messages missed, %d new payments",
+                   group_id, park.name, len(messages), submitted)
+    return submitted
+
+
+async def catch_up(client, routes, chat_ids: dict, checkpoints: GroupCheckpoints, submit, *,
+                   limit: int = 5000, rate: float = 20.0) -> int:
+    """Run ``catch_up_group`` for every routed group, one group at a time."""
+    total = 0
+    for group_id, park in routes.items():
+        try:
+            total += await catch_up_group(client, chat_ids[group_id], group_id, park, checkpoints, submit,
+                                          limit=limit, rate=rate)
+        except Exception as e:
+            logger.error("catch-up for group %s failed: %s", group_id, e)
+    return total
@@ -1,5 +1,15 @@
+import asyncio
+import logging
 import os
-from dotenv import load_dotenv
+import re
+from decimal import Decimal
+from types import MappingProxyType
+from dotenv import load_dotenv, dotenv_values
+
+from yandex import YandexTaxiAPI, RetryPolicy, RetryBudget, CircuitBreaker
+from drivers import DriverIndex
+
+logger = logging.getLogger(__name__)
 
 # Load .env file
 load_dotenv()
@@ -13,6 +23,102 @@ DASHBOARD_SECRET = os.getenv("DASHBOARD_SECRET")
 PROVIDER_PAYME = os.getenv("PROVIDER_PAYME")
 PROVIDER_CLICK = os.getenv("PROVIDER_CLICK")
 
+# === TELEGRAM NOTIFICATIONS ===
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org")
+NOTIFY_QUEUE_SIZE = int(os.getenv("NOTIFY_QUEUE_SIZE", 1000))
+# Telegram allows about 20 messages a minute into one group and 30 a second per bot
+NOTIFY_CHAT_INTERVAL = float(os.getenv("NOTIFY_CHAT_INTERVAL", 3))
+NOTIFY_GLOBAL_RATE = float(os.getenv("NOTIFY_GLOBAL_RATE", 30))
+NOTIFY_DIGEST = os.getenv("NOTIFY_DIGEST", "0").lower() in ("1", "true", "yes")
+
+# === RECOVERY OF STUCK PAYMENTS ===
+RECOVERY_INTERVAL = float(os.getenv("RECOVERY_INTERVAL", 60))
+RECOVERY_MIN_AGE = float(os.getenv("RECOVERY_MIN_AGE", 300))
+RECOVERY_PARK_CONCURRENCY = int(os.getenv("RECOVERY_PARK_CONCURRENCY", 2))
+RECOVERY_BATCH_SIZE = int(os.getenv("RECOVERY_BATCH_SIZE", 200))
+
+# === PAYMENT INTAKE ===
+# Payment messages are processed by PAYMENT_WORKERS tasks; past PAYMENT_QUEUE_HIGH waiting
+# payments new ones are only saved as 'created' until the queue is back at PAYMENT_QUEUE_LOW
+PAYMENT_WORKERS = int(os.getenv("PAYMENT_WORKERS", 32))
+PAYMENT_QUEUE_HIGH = int(os.getenv("PAYMENT_QUEUE_HIGH", 500))
+PAYMENT_QUEUE_LOW = int(os.getenv("PAYMENT_QUEUE_LOW", 100))
+PAYMENT_DRAIN_TIMEOUT = float(os.getenv("PAYMENT_DRAIN_TIMEOUT", 20))
+
+# === STARTUP CATCH-UP ===
+# On startup, payment messages posted to the groups while the bot was down are replayed from
+# the chat history, starting after each group's stored checkpoint
+CATCHUP_ENABLED = os.getenv("CATCHUP_ENABLED", "1").lower() in ("1", "true", "yes")
+CATCHUP_LIMIT = int(os.getenv("CATCHUP_LIMIT", 5000))
+CATCHUP_RATE = float(os.getenv("CATCHUP_RATE", 20))
+CHECKPOINT_FLUSH_INTERVAL = float(os.getenv("CHECKPOINT_FLUSH_INTERVAL", 5))
+
+# How many recently performed (provider, txn id) pairs are kept in memory to drop redeliveries early
+PERFORMED_CACHE_SIZE = int(os.getenv("PERFORMED_CACHE_SIZE", 100_000))
+
+# === PAYLOAD ARCHIVE ===
+# raw_payload of payments performed more than ARCHIVE_AFTER_DAYS ago is moved, compressed, to
+# <db>_archive.db every ARCHIVE_INTERVAL seconds; 0 days turns it off
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", 30))
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL", 6 * 3600))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", 500))
+
+# === TOP-UP SCHEDULING ===
+# Top-ups run in order per driver; with a window > 0, payments of at most TOPUP_BATCH_MAX_AMOUNT
+# (0 = any) for one driver arriving within it go out as one Yandex transaction, each keeping its row
+TOPUP_BATCH_WINDOW = float(os.getenv("TOPUP_BATCH_WINDOW", 0))
+TOPUP_MAX_BATCH = int(os.getenv("TOPUP_MAX_BATCH", 10))
+TOPUP_BATCH_MAX_AMOUNT = Decimal(os.getenv("TOPUP_BATCH_MAX_AMOUNT", "0"))
+
+# === WORKERS ===
+# supervisor.py runs WORKER_COUNT bot processes; worker WORKER_INDEX loads only its share of
+# the parks (every group of one Yandex park on the same worker). 1 = one process, all parks
+WORKER_COUNT = max(1, int(os.getenv("WORKER_COUNT", 1)))
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", 0))
+
+# === PARK RELOAD ===
+# PARKn_* settings are re-read from PARKS_FILE on SIGHUP, and whenever the file changes if
+# PARKS_RELOAD_INTERVAL > 0 (seconds between checks). Parks whose Yandex credentials did not
+# change keep their Fleet API client and driver index; those of removed parks are closed once
+# the payments still holding them are done, checked every PARKS_RETIRE_DELAY seconds
+PARKS_FILE = os.getenv("PARKS_FILE", ".env")
+PARKS_RELOAD_INTERVAL = float(os.getenv("PARKS_RELOAD_INTERVAL", 5))
+PARKS_RETIRE_DELAY = float(os.getenv("PARKS_RETIRE_DELAY", 60))
+
+# === METRICS ===
+# Prometheus text format on http://METRICS_HOST:METRICS_PORT/metrics, health on /healthz;
+# worker n of a supervisor listens on METRICS_PORT + n. Port 0 turns it off
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9108))
+
+# === YANDEX HTTP CLIENT ===
+YANDEX_API_BASE = os.getenv("YANDEX_API_BASE", "https://fleet-api.taxi.yandex.net")
+YANDEX_MAX_CONNECTIONS = int(os.getenv("YANDEX_MAX_CONNECTIONS", 10))
+YANDEX_MAX_KEEPALIVE = int(os.getenv("YANDEX_MAX_KEEPALIVE", 5))
+YANDEX_KEEPALIVE_EXPIRY = float(os.getenv("YANDEX_KEEPALIVE_EXPIRY", 60))
+YANDEX_TIMEOUT = float(os.getenv("YANDEX_TIMEOUT", 30))
+YANDEX_CONNECT_TIMEOUT = float(os.getenv("YANDEX_CONNECT_TIMEOUT", 10))
+YANDEX_HTTP2 = os.getenv("YANDEX_HTTP2", "1").lower() not in ("0", "false", "no")
+YANDEX_RETRY_ATTEMPTS = int(os.getenv("YANDEX_RETRY_ATTEMPTS", 3))
+YANDEX_RETRY_BASE_DELAY = float(os.getenv("YANDEX_RETRY_BASE_DELAY", 0.5))
+YANDEX_RETRY_MAX_DELAY = float(os.getenv("YANDEX_RETRY_MAX_DELAY", 10))
+# Per park: at most YANDEX_RETRY_BUDGET retries in a burst, refilled at YANDEX_RETRY_BUDGET_REFILL per second
+YANDEX_RETRY_BUDGET = float(os.getenv("YANDEX_RETRY_BUDGET", 10))
+YANDEX_RETRY_BUDGET_REFILL = float(os.getenv("YANDEX_RETRY_BUDGET_REFILL", 0.5))
+YANDEX_BREAKER_FAILURES = int(os.getenv("YANDEX_BREAKER_FAILURES", 5))
+YANDEX_BREAKER_RESET = float(os.getenv("YANDEX_BREAKER_RESET", 30))
+YANDEX_PARK_CONCURRENCY = int(os.getenv("YANDEX_PARK_CONCURRENCY", 8))
+YANDEX_GLOBAL_CONCURRENCY = int(os.getenv("YANDEX_GLOBAL_CONCURRENCY", 32))
+
+# Shared by every park's client: total in-flight Fleet API requests
+YANDEX_GLOBAL_LIMIT = asyncio.Semaphore(YANDEX_GLOBAL_CONCURRENCY)
+
+# === DRIVER INDEX ===
+DRIVER_INDEX_TTL = float(os.getenv("DRIVER_INDEX_TTL", 6 * 3600))
+DRIVER_INDEX_REFRESH_INTERVAL = float(os.getenv("DRIVER_INDEX_REFRESH_INTERVAL", 30))
+DRIVER_INDEX_PAGE_SIZE = int(os.getenv("DRIVER_INDEX_PAGE_SIZE", 1000))
+DRIVER_NEGATIVE_TTL = float(os.getenv("DRIVER_NEGATIVE_TTL", 30))
+
 
 # === HELPERS ===
 def parse_list(value: str) -> list[str]:
@@ -24,7 +130,7 @@ def parse_list(value: str) -> list[str]:
 # === LOAD PARKS ===
 class Park:
     def __init__(self, name, api_key, clid, park_id, telegram_groups, notification_chat_id,
-                 allowed_users, payment_fee, sticker_success, sticker_error, provider):
+                 allowed_users, payment_fee, sticker_success, sticker_error, provider, api=None):
         self.name = name
         self.api_key = api_key
         self.clid = clid
@@ -36,33 +142,207 @@ class Park:
         self.sticker_success = sticker_success
         self.sticker_error = sticker_error
         self.provider = provider
+        # Payments queued or running with this Park; a reload closes a retired client only at 0
+        self.in_flight = 0
+        # Long-lived, pooled Fleet API client; load_parks_from_env passes the one to share
+        self.api = api or YandexTaxiAPI(
+            park_id, clid, api_key,
+            max_connections=YANDEX_MAX_CONNECTIONS,
+            max_keepalive_connections=YANDEX_MAX_KEEPALIVE,
+            keepalive_expiry=YANDEX_KEEPALIVE_EXPIRY,
+            timeout=YANDEX_TIMEOUT,
+            connect_timeout=YANDEX_CONNECT_TIMEOUT,
+            http2=YANDEX_HTTP2,
+            retry_policy=RetryPolicy(YANDEX_RETRY_ATTEMPTS, YANDEX_RETRY_BASE_DELAY, YANDEX_RETRY_MAX_DELAY),
+            retry_budget=RetryBudget(YANDEX_RETRY_BUDGET, YANDEX_RETRY_BUDGET_REFILL),
+            breaker=CircuitBreaker(name, YANDEX_BREAKER_FAILURES, YANDEX_BREAKER_RESET),
+            max_in_flight=YANDEX_PARK_CONCURRENCY,
+            global_limit=YANDEX_GLOBAL_LIMIT,
+            api_base=YANDEX_API_BASE,
+        )
+
 
+def load_parks_from_env(worker_index: int = 0, worker_count: int = 1, env=None, previous=None):
+    """PARKn_* parks from ``env`` (default os.environ); with ``worker_count > 1`` only ``worker_index``'s.
 
-def load_parks_from_env():
+    Yandex parks are dealt out to the workers round-robin in the order they first appear, so
+    adding a park at the end doesn't move the others. Entries with the same Yandex
+    credentials (e.g. NAME_click / NAME_payme) share one Fleet API client, so one breaker,
+    retry budget and YANDEX_PARK_CONCURRENCY cap; a client of ``previous`` with those
+    credentials, and its driver index, carry over to the new parks.
+    """
+    env = os.environ if env is None else env
+    apis = {(park.park_id, park.clid, park.api_key): park.api for park in (previous or {}).values()}
+    previous_indexes = {id(park.drivers.api): park.drivers for park in (previous or {}).values()}
     parks = {}
+    indexes_by_park_id = {}
+    workers_by_park_id = {}
     idx = 1
 
     while True:
-        if not os.getenv(f"PARK{idx}_NAME"):
+        if not env.get(f"PARK{idx}_NAME"):
             break
 
+        park_id = env.get(f"PARK{idx}_PARK_ID")
+        worker = workers_by_park_id.setdefault(park_id, len(workers_by_park_id) % worker_count)
+        if worker != worker_index:
+            idx += 1
+            continue
+
+        name = env.get(f"PARK{idx}_NAME")
+        api_key = env.get(f"PARK{idx}_API_KEY")
+        clid = env.get(f"PARK{idx}_CLID")
+
         parks[f"PARK{idx}"] = Park(
-            name=os.getenv(f"PARK{idx}_NAME"),
-            api_key=os.getenv(f"PARK{idx}_API_KEY"),
-            clid=os.getenv(f"PARK{idx}_CLID"),
-            park_id=os.getenv(f"PARK{idx}_PARK_ID"),
-            telegram_groups=parse_list(os.getenv(f"PARK{idx}_TELEGRAM_GROUPS", "")),
-            notification_chat_id=os.getenv(f"PARK{idx}_NOTIFICATION_CHAT_ID"),
-            allowed_users=parse_list(os.getenv(f"PARK{idx}_ALLOWED_USERS", "")),
-            payment_fee=int(os.getenv(f"PARK{idx}_PAYMENT_FEE", 0)),
-            sticker_success=os.getenv(f"PARK{idx}_STICKER_SUCCESS", "✅"),
-            sticker_error=os.getenv(f"PARK{idx}_STICKER_ERROR", "❌"),
-            provider=os.getenv(f"PARK{idx}_PROVIDER"),
+            name=name,
+            api_key=api_key,
+            clid=clid,
+            park_id=park_id,
+            telegram_groups=parse_list(env.get(f"PARK{idx}_TELEGRAM_GROUPS", "")),
+            notification_chat_id=env.get(f"PARK{idx}_NOTIFICATION_CHAT_ID"),
+            allowed_users=parse_list(env.get(f"PARK{idx}_ALLOWED_USERS", "")),
+            payment_fee=int(env.get(f"PARK{idx}_PAYMENT_FEE", 0)),
+            sticker_success=env.get(f"PARK{idx}_STICKER_SUCCESS", "✅"),
+            sticker_error=env.get(f"PARK{idx}_STICKER_ERROR", "❌"),
+            provider=env.get(f"PARK{idx}_PROVIDER"),
+            api=apis.get((park_id, clid, api_key)),
         )
+        park = parks[f"PARK{idx}"]
+        apis.setdefault((park_id, clid, api_key), park.api)
+        # Groups of the same Yandex park (e.g. NAME_click / NAME_payme) share one driver index
+        reused = previous_indexes.get(id(park.api))
+        if park.park_id not in indexes_by_park_id and reused is not None and reused.api is park.api:
+            indexes_by_park_id[park.park_id] = reused
+        if park.park_id not in indexes_by_park_id:
+            indexes_by_park_id[park.park_id] = DriverIndex(
+                park.api,
+                ttl=DRIVER_INDEX_TTL,
+                refresh_interval=DRIVER_INDEX_REFRESH_INTERVAL,
+                page_size=DRIVER_INDEX_PAGE_SIZE,
+                negative_ttl=DRIVER_NEGATIVE_TTL,
+            )
+        park.drivers = indexes_by_park_id[park.park_id]
         idx += 1
 
     return parks
 
 
+def build_group_routes(parks) -> MappingProxyType:
+    """Frozen telegram group id -> Park table; a group assigned to two parks is a config error."""
+    routes = {}
+    for park in parks.values():
+        for group_id in park.telegram_groups:
+            other = routes.get(group_id)
+            if other is not None and other is not park:
+                raise ValueError(f"Telegram group {group_id} is assigned to both {other.name} and {park.name}")
+            routes[group_id] = park
+    return MappingProxyType(routes)
+
+
+def park_apis(parks) -> list:
+    unique = {}
+    for park in parks.values():
+        unique[id(park.api)] = park.api
+    return list(unique.values())
+
+
+def driver_indexes(parks) -> list:
+    unique = {}
+    for park in parks.values():
+        unique[id(park.drivers)] = park.drivers
+    return list(unique.values())
+
+
+async def start_parks(parks) -> None:
+    await _start_indexes(driver_indexes(parks))
+
+
+async def _start_indexes(indexes: list) -> None:
+    loaded = await asyncio.gather(*(index.load_persisted() for index in indexes))
+    # A warm index from disk can serve payments while the full build runs in the background
+    cold = [index for index, count in zip(indexes, loaded) if not count]
+    await asyncio.gather(*(index.build() for index in cold))
+    for index, count in zip(indexes, loaded):
+        index.start(rebuild=bool(count))
+
+
+async def _close(indexes: list, apis: list) -> None:
+    for index in indexes:
+        await index.stop()
+    for api in apis:
+        await api.aclose()
+
+
+async def close_parks(parks) -> None:
+    await _close(driver_indexes(parks), park_apis(parks))
+    # Clients of parks removed by a reload that are still waiting out their delay
+    for task in list(_retiring):
+        task.cancel()
+    await asyncio.gather(*_retiring, return_exceptions=True)
+
+
+def _parks_env() -> dict:
+    """Environment for a reload: PARKn_* as PARKS_FILE has them now, everything else as at startup."""
+    env = {key: value for key, value in os.environ.items() if not _PARK_KEY.match(key)}
+    from_file = {key: value for key, value in dotenv_values(PARKS_FILE).items()
+                 if _PARK_KEY.match(key) and value is not None}
+    if not from_file.get("PARK1_NAME"):
+        raise ValueError(f"{PARKS_FILE} defines no PARK1_NAME")
+    env.update(from_file)
+    return env
+
+
+async def _retire(parks: list, indexes: list, apis: list) -> None:
+    # Queued payments keep the Park they came in with, so its client has to outlive them
+    try:
+        await asyncio.sleep(PARKS_RETIRE_DELAY)
+        while any(park.in_flight for park in parks):
+            await asyncio.sleep(PARKS_RETIRE_DELAY)
+    finally:
+        await _close(indexes, apis)
+
+
+async def reload_parks() -> tuple:
+    """Re-read the parks from PARKS_FILE and swap PARKS / GROUP_ROUTES for the new set.
+
+    Unchanged parks keep their clients and caches; new driver indexes are loaded before the
+    swap. Both tables are replaced together and never mutated, so code holding the old ones
+    (in-flight payments) keeps a consistent view. Raises, swapping nothing, on a bad file.
+    Returns ``(old_parks, new_parks)``.
+    """
+    global PARKS, GROUP_ROUTES
+    old_parks = PARKS
+    parks = load_parks_from_env(WORKER_INDEX, WORKER_COUNT, _parks_env(), previous=old_parks)
+    old_indexes = driver_indexes(old_parks)
+    new_indexes = [index for index in driver_indexes(parks) if index not in old_indexes]
+    old_apis = park_apis(old_parks)
+    new_apis = [api for api in park_apis(parks) if api not in old_apis]
+    try:
+        routes = build_group_routes(parks)
+        await _start_indexes(new_indexes)
+    except BaseException:
+        await _close(new_indexes, new_apis)
+        raise
+
+    PARKS, GROUP_ROUTES = MappingProxyType(parks), routes
+
+    kept_apis = park_apis(parks)
+    gone_indexes = [index for index in old_indexes if index not in driver_indexes(parks)]
+    gone_apis = [api for api in old_apis if api not in kept_apis]
+    if gone_indexes or gone_apis:
+        holders = [park for park in old_parks.values() if park.api in gone_apis or park.drivers in gone_indexes]
+        task = asyncio.create_task(_retire(holders, gone_indexes, gone_apis))
+        _retiring.add(task)
+        task.add_done_callback(_retiring.discard)
+    logger.warning("parks reloaded: %d parks, %d groups, %d new clients, %d retired",
+                   len(parks), len(routes), len(new_apis), len(gone_apis))
+    return old_parks, PARKS
+
+
 # === READY PARKS CONFIG ===
-PARKS = load_parks_from_env()
+_PARK_KEY = re.compile(r"PARK\d+_")
+_retiring: set = set()
+
+# Immutable snapshots: a reload replaces them (reload_parks()), so read them as config.PARKS
+PARKS = MappingProxyType(load_parks_from_env(WORKER_INDEX, WORKER_COUNT))
+GROUP_ROUTES = build_group_routes(PARKS)
@@ -1,15 +1,88 @@
+import asyncio
+import os
 import sqlite3
 import json
-from decimal import Decimal
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from decimal import Decimal, ROUND_HALF_UP
 from datetime import datetime
 from typing import Tuple, Optional
 
+from metrics import DB_SECONDS
+
 DB_NAME = "payment_bot.db"
+# Compressed raw_payload of archived payments lives in its own file next to DB_NAME,
+# <name>_archive.db unless set; see archive_payloads()
+ARCHIVE_DB_NAME = None
+
+# Connection tuning; see _connect()
+DB_CACHE_SIZE_KB = 64 * 1024
+DB_MMAP_SIZE = 256 * 1024 * 1024
+DB_BUSY_TIMEOUT_MS = 5000
+DB_STATEMENT_CACHE = 256
+
+# All blocking sqlite work for the async pipeline runs here, off the event loop.
+# One worker keeps writes serialized, which is what sqlite wants anyway.
+_DB_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+
+
+_local = threading.local()
+
 
+def _connect(db_name: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_name, isolation_level=None, detect_types=sqlite3.PARSE_DECLTYPES,
+                           cached_statements=DB_STATEMENT_CACHE)
+    # Lets incremental_vacuum() shrink the file. Must come before the WAL switch creates a new
+    # file; an existing file without it needs one VACUUM (python archive.py --convert).
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    # WAL: commits append to the log instead of rewriting pages, readers don't block the writer.
+    # synchronous=NORMAL only fsyncs at checkpoints; a commit can't be torn, at worst the last
+    # transactions before a power cut are lost (an application crash loses nothing).
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    return conn
 
-def get_conn():
-    # Use check_same_thread=False if you plan to call DB from threads, but Pyrogram handlers are async tasks in same process.
-    return sqlite3.connect(DB_NAME, isolation_level=None, detect_types=sqlite3.PARSE_DECLTYPES)
+
+def get_conn() -> sqlite3.Connection:
+    """Long-lived connection of the calling thread (in practice the DB worker thread).
+
+    Callers must not close it; statements prepared on it stay in its statement cache.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.db_name != DB_NAME:
+        if conn is not None:
+            conn.close()
+        conn = _local.conn = _connect(DB_NAME)
+        _local.db_name = DB_NAME
+    return conn
+
+
+def close_conn() -> None:
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+
+@contextmanager
+def transaction():
+    conn = get_conn()
+    # IMMEDIATE takes the write lock up front, waiting up to busy_timeout for it; a deferred
+    # transaction that has read first fails at once with SQLITE_BUSY when another process
+    # (a supervisor worker) wrote in between
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
 
 
 def init_db():
@@ -35,105 +108,726 @@ def init_db():
     )
     """)
 
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_provider_txn_id ON payments (provider, provider_txn_id)")
     cur.execute("CREATE INDEX IF NOT EXISTS idx_callsign ON payments (callsign)")
     cur.execute("CREATE INDEX IF NOT EXISTS idx_status ON payments (status)")
     cur.execute("CREATE INDEX IF NOT EXISTS idx_park_group ON payments (park_group_id)")
 
+    # Resolved drivers, so a restart does not start with a cold driver index
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS drivers (
+        park_id TEXT NOT NULL,
+        callsign TEXT NOT NULL,       -- upper-cased car.callsign
+        driver_profile_id TEXT NOT NULL,
+        profile TEXT,                 -- driver-profiles/list item as JSON
+        verified_at TEXT NOT NULL,
+        invalid INTEGER DEFAULT 0,
+        PRIMARY KEY (park_id, callsign)
+    )
+    """)
+
     conn.commit()
-    conn.close()
+
+    migrate(conn)
+
+
+def _drop_redundant_txn_index(conn):
+    # UNIQUE(provider, provider_txn_id) already has its own index
+    conn.execute("DROP INDEX IF EXISTS idx_provider_txn_id")
+
+
+def _add_idempotency_token(conn):
+    conn.execute("ALTER TABLE payments ADD COLUMN idempotency_token TEXT")
+
+
+def _add_group_checkpoints(conn):
+    # Last message id per Telegram group up to which every message has been handled
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS group_checkpoints (
+            group_id TEXT PRIMARY KEY,
+            last_message_id INTEGER NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+    """)
+
+
+def _add_amount_tiyin(conn):
+    # Integer minor units (1 UZS = 100 tiyin) so reports can SUM without casting text
+    conn.execute("ALTER TABLE payments ADD COLUMN amount_tiyin INTEGER")
+    conn.execute("UPDATE payments SET amount_tiyin = CAST(ROUND(CAST(amount AS REAL) * 100) AS INTEGER)")
+
+
+def _add_report_indexes(conn):
+    # Covering indexes for payment_totals(): per park, and across parks, by performed_at range
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_park_status_performed
+        ON payments (park_group_id, status, performed_at, category_id, amount_tiyin)
+    """)
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_status_performed
+        ON payments (status, performed_at, park_group_id, category_id, amount_tiyin)
+    """)
+
+
+# Day a finished payment is rolled up under: when it was performed, for a failed one when it came in
+_ROLLUP_DAY = "substr(COALESCE({row}.performed_at, {row}.created_at), 1, 10)"
+_ROLLUP_COLUMNS = "status, performed_at, created_at, park_group_id, provider, amount_tiyin, topup_tiyin"
+
+
+def _rollup_delta(row: str, sign: str) -> str:
+    # Adds (sign "+") or removes (sign "-") one payment row of a trigger to/from its daily bucket
+    return f"""
+        INSERT INTO payment_daily_totals (day, park_group_id, provider, status, count, amount_tiyin, topup_tiyin)
+        SELECT {_ROLLUP_DAY.format(row=row)}, COALESCE({row}.park_group_id, ''), {row}.provider, {row}.status,
+               {sign}1, {sign}COALESCE({row}.amount_tiyin, 0), {sign}COALESCE({row}.topup_tiyin, 0)
+        WHERE {row}.status IN ('performed', 'failed')
+        ON CONFLICT(day, park_group_id, provider, status) DO UPDATE SET
+            count = count + excluded.count,
+            amount_tiyin = amount_tiyin + excluded.amount_tiyin,
+            topup_tiyin = topup_tiyin + excluded.topup_tiyin;
+    """
+
+
+def _add_daily_totals(conn):
+    # Per day/park/provider totals of performed and failed payments, kept current by triggers
+    # on every write to payments so dashboards never scan it; rebuild_daily_totals() backfills.
+    # topup_tiyin is what the driver was credited after the park's fee (set with 'performed').
+    conn.execute("ALTER TABLE payments ADD COLUMN topup_tiyin INTEGER")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS payment_daily_totals (
+            day TEXT NOT NULL,
+            park_group_id TEXT NOT NULL,
+            provider TEXT NOT NULL,
+            status TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            amount_tiyin INTEGER NOT NULL,
+            topup_tiyin INTEGER NOT NULL,
+            PRIMARY KEY (day, park_group_id, provider, status)
+        ) WITHOUT ROWID
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS payments_daily_insert AFTER INSERT ON payments
+        WHEN NEW.status IN ('performed', 'failed')
+        BEGIN {_rollup_delta("NEW", "+")} END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS payments_daily_update AFTER UPDATE OF {_ROLLUP_COLUMNS} ON payments
+        WHEN OLD.status IN ('performed', 'failed') OR NEW.status IN ('performed', 'failed')
+        BEGIN {_rollup_delta("OLD", "-")} {_rollup_delta("NEW", "+")} END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS payments_daily_delete AFTER DELETE ON payments
+        WHEN OLD.status IN ('performed', 'failed')
+        BEGIN {_rollup_delta("OLD", "-")} END
+    """)
+    _fill_daily_totals(conn)
+
+
+def _add_token_index(conn):
+    # Members of a combined top-up are looked up by their shared token
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_idempotency_token ON payments (idempotency_token)")
+
+
+# Applied in order on top of the schema above; PRAGMA user_version records how many ran.
+# Append only: never edit or reorder an entry that has shipped.
+MIGRATIONS = [
+    _drop_redundant_txn_index,
+    _add_idempotency_token,
+    _add_group_checkpoints,
+    _add_amount_tiyin,
+    _add_report_indexes,
+    _add_daily_totals,
+    _add_token_index,
+]
+
+
+def migrate(conn) -> None:
+    # Each step commits on ``conn`` itself: transaction() would take get_conn()'s connection,
+    # which need not be this one, and wait on the lock this one holds
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, step in enumerate(MIGRATIONS[version:], start=version + 1):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            step(conn)
+            conn.execute(f"PRAGMA user_version = {number}")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+
+def to_tiyin(amount) -> int:
+    return int((Decimal(str(amount)) * 100).quantize(Decimal("1"), rounding=ROUND_HALF_UP))
 
 
 def save_payment(provider: str, provider_txn_id: str, callsign: str, amount: Decimal,
                  category_id: str, raw_payload: dict, status: str = "created",
                  driver_profile_id: str = "", performed_at: Optional[str] = None,
-                 park_group_id: Optional[int] = None) -> Tuple[bool, dict, str]:
+                 park_group_id: Optional[int] = None,
+                 idempotency_token: Optional[str] = None) -> Tuple[bool, dict, str]:
+    raw_payload_str = json.dumps(raw_payload, ensure_ascii=False) if raw_payload else "{}"
+    amount_str = str(amount)
+
     conn = get_conn()
     cur = conn.cursor()
     try:
-        cur.execute("BEGIN")
+        # This row is the idempotency guard for the top-up that follows, so it must reach
+        # the disk before we return, not just the WAL in the OS cache.
+        cur.execute("PRAGMA synchronous=FULL")
+        # A retry of a payment that is not performed yet overwrites it in place;
+        # a performed one is left alone and returns no row.
+        cur.execute("""
+            INSERT INTO payments
+            (provider, provider_txn_id, callsign, amount, amount_tiyin, currency, category_id,
+             status, raw_payload, driver_profile_id, performed_at, park_group_id, idempotency_token)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(provider, provider_txn_id) DO UPDATE SET
+                callsign = excluded.callsign, amount = excluded.amount, amount_tiyin = excluded.amount_tiyin,
+                currency = excluded.currency,
+                category_id = excluded.category_id, status = excluded.status,
+                raw_payload = excluded.raw_payload, driver_profile_id = excluded.driver_profile_id,
+                performed_at = excluded.performed_at, park_group_id = excluded.park_group_id,
+                idempotency_token = COALESCE(payments.idempotency_token, excluded.idempotency_token)
+            WHERE payments.status != 'performed'
+            RETURNING id, status, idempotency_token
+        """, (provider, provider_txn_id, callsign, amount_str, to_tiyin(amount), "UZS", category_id,
+              status, raw_payload_str, driver_profile_id, performed_at, park_group_id, idempotency_token))
+        rows = cur.fetchall()
+        if rows:
+            payment_id, saved_status, saved_token = rows[0]
+            return True, {"id": payment_id, "status": saved_status, "idempotency_token": saved_token}, "ok"
+
         cur.execute(
-            "SELECT id, status FROM payments WHERE provider = ? AND provider_txn_id = ?",
+            "SELECT id FROM payments WHERE provider = ? AND provider_txn_id = ?",
             (provider, provider_txn_id)
         )
-        existing = cur.fetchone()
-        if existing:
-            payment_id, existing_status = existing
-            if existing_status == "performed":
-                cur.execute("COMMIT")
-                return False, {"id": payment_id, "status": existing_status}, "already performed"
-        else:
-            payment_id = None
-
-        raw_payload_str = json.dumps(raw_payload, ensure_ascii=False) if raw_payload else "{}"
-        amount_str = str(amount)
-
-        if existing:
-            cur.execute("""
-                UPDATE payments
-                SET callsign = ?, amount = ?, currency = ?, category_id = ?, status = ?,
-                    raw_payload = ?, driver_profile_id = ?, performed_at = ?, park_group_id = ?
-                WHERE id = ?
-            """, (callsign, amount_str, "UZS", category_id, status,
-                  raw_payload_str, driver_profile_id, performed_at, park_group_id, payment_id))
-        else:
-            cur.execute("""
-                INSERT INTO payments
-                (provider, provider_txn_id, callsign, amount, currency, category_id,
-                 status, raw_payload, driver_profile_id, performed_at, park_group_id)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (provider, provider_txn_id, callsign, amount_str, "UZS", category_id,
-                  status, raw_payload_str, driver_profile_id, performed_at, park_group_id))
-            payment_id = cur.lastrowid
-
-        cur.execute("COMMIT")
-
-        cur.execute("SELECT * FROM payments WHERE id = ?", (payment_id,))
-        columns = [c[0] for c in cur.description]
-        row = cur.fetchone()
-        payment_data = dict(zip(columns, row))
-        return True, payment_data, "ok"
+        payment_id = cur.fetchone()[0]
+        return False, {"id": payment_id, "status": "performed"}, "already performed"
 
     except Exception as e:
-        try:
-            cur.execute("ROLLBACK")
-        except Exception:
-            pass
         return False, {}, f"db error: {e}"
     finally:
-        conn.close()
+        cur.execute("PRAGMA synchronous=NORMAL")
+
+
+def _status_update(cur, payment_id: int, status: str, driver_profile_id: str = None,
+                   performed_at: str = None, topup_tiyin: int = None) -> bool:
+    if not performed_at and status == "performed":
+        performed_at = datetime.utcnow().isoformat(timespec="seconds")
+    assignments, params = ["status = ?"], [status]
+    if driver_profile_id and performed_at:
+        assignments.append("driver_profile_id = ?")
+        params.append(driver_profile_id)
+    if performed_at:
+        assignments.append("performed_at = ?")
+        params.append(performed_at)
+    if topup_tiyin is not None:
+        assignments.append("topup_tiyin = ?")
+        params.append(topup_tiyin)
+    cur.execute(f"UPDATE payments SET {', '.join(assignments)} WHERE id = ?", (*params, payment_id))
+    return cur.rowcount > 0
 
 
 def update_payment_status(payment_id: int, status: str,
                           driver_profile_id: str = None,
-                          performed_at: str = None) -> bool:
+                          performed_at: str = None,
+                          topup_tiyin: int = None) -> bool:
     conn = get_conn()
     cur = conn.cursor()
     try:
-        if not performed_at and status == "performed":
-            performed_at = datetime.utcnow().isoformat(timespec="seconds")
-        if driver_profile_id and performed_at:
-            cur.execute(
-                "UPDATE payments SET status = ?, driver_profile_id = ?, performed_at = ? WHERE id = ?",
-                (status, driver_profile_id, performed_at, payment_id)
-            )
-        elif performed_at:
-            cur.execute(
-                "UPDATE payments SET status = ?, performed_at = ? WHERE id = ?",
-                (status, performed_at, payment_id)
-            )
-        else:
-            cur.execute(
-                "UPDATE payments SET status = ? WHERE id = ?",
-                (status, payment_id)
-            )
+        updated = _status_update(cur, payment_id, status, driver_profile_id, performed_at, topup_tiyin)
         conn.commit()
-        return cur.rowcount > 0
+        return updated
     except Exception:
         try:
             conn.rollback()
         except Exception:
             pass
         return False
-    finally:
-        conn.close()
+
+
+def update_payment_statuses(updates: list) -> list:
+    """Apply several ``(payment_id, status, driver_profile_id, performed_at, topup_tiyin)`` transitions in one commit.
+
+    Returns one "row updated" flag per transition. If the batch fails as a whole, each
+    transition is retried in its own transaction so one bad row can't sink the rest.
+    """
+    conn = get_conn()
+    cur = conn.cursor()
+    try:
+        with transaction():
+            return [_status_update(cur, *update) for update in updates]
+    except Exception:
+        return [update_payment_status(*update) for update in updates]
+
+
+def _parks_filter(park_group_ids: Optional[list]) -> tuple:
+    # Extra WHERE clause and its parameter limiting a query to some parks; none when None
+    if park_group_ids is None:
+        return "", ()
+    return " AND park_group_id IN (SELECT value FROM json_each(?))", (json.dumps(list(park_group_ids)),)
+
+
+def fetch_payments_by_status(status: str, min_age_seconds: int = 0, limit: int = 100,
+                             park_group_ids: Optional[list] = None, after_id: int = 0) -> list:
+    """Oldest payments in ``status`` created at least ``min_age_seconds`` ago (served by idx_status).
+
+    ``park_group_ids`` limits them to those parks (a worker serving a share of the parks);
+    ``after_id`` pages through them, starting after the last id of the previous page.
+    """
+    parks, parks_params = _parks_filter(park_group_ids)
+    cur = get_conn().execute(f"""
+        SELECT id, provider, provider_txn_id, callsign, amount, category_id, raw_payload, park_group_id,
+               idempotency_token
+        FROM payments
+        WHERE status = ? AND id > ? AND created_at <= datetime('now', ?){parks}
+        ORDER BY id
+        LIMIT ?
+    """, (status, after_id, f"-{int(min_age_seconds)} seconds", *parks_params, limit))
+    columns = [c[0] for c in cur.description]
+    return [dict(zip(columns, row)) for row in cur.fetchall()]
+
+
+def reopen_token_groups(tokens: list) -> list:
+    """Every member of the combined top-ups ``tokens``, as 'created' rows to replay together.
+
+    A combined top-up's token was sent with the group's total, so it may only be resent with
+    the whole group: once a member is back in 'created' (its message was redelivered), the
+    members that failed with it go back to 'created' as well. A group with a performed
+    member already went through and is left out.
+    """
+    if not tokens:
+        return []
+    placeholders = ",".join("?" * len(tokens))
+    open_groups = f"""
+        idempotency_token IN (
+            SELECT idempotency_token FROM payments
+            WHERE status = 'created' AND idempotency_token IN ({placeholders}))
+        AND idempotency_token NOT IN (
+            SELECT idempotency_token FROM payments
+            WHERE status = 'performed' AND idempotency_token IN ({placeholders}))
+    """
+    with transaction() as conn:
+        conn.execute(f"UPDATE payments SET status = 'created' WHERE status = 'failed' AND {open_groups}",
+                     (*tokens, *tokens))
+        cur = conn.execute(f"""
+            SELECT id, provider, provider_txn_id, callsign, amount, category_id, raw_payload, park_group_id,
+                   idempotency_token
+            FROM payments
+            WHERE status = 'created' AND {open_groups}
+            ORDER BY id
+        """, (*tokens, *tokens))
+        columns = [c[0] for c in cur.description]
+        return [dict(zip(columns, row)) for row in cur.fetchall()]
+
+
+def existing_txn_ids(provider: str, provider_txn_ids: list) -> set:
+    """Which of ``provider_txn_ids`` already have a payment row, in one query per 500 ids."""
+    found = set()
+    ids = list(dict.fromkeys(provider_txn_ids))
+    for start in range(0, len(ids), 500):
+        chunk = ids[start:start + 500]
+        placeholders = ",".join("?" * len(chunk))
+        cur = get_conn().execute(
+            f"SELECT provider_txn_id FROM payments WHERE provider = ? AND provider_txn_id IN ({placeholders})",
+            (provider, *chunk)
+        )
+        found.update(row[0] for row in cur.fetchall())
+    return found
+
+
+def recent_performed_txn_ids(limit: int) -> list:
+    """``(provider, provider_txn_id)`` of the latest ``limit`` performed payments, oldest first."""
+    cur = get_conn().execute("""
+        SELECT provider, provider_txn_id FROM payments
+        WHERE status = 'performed'
+        ORDER BY id DESC
+        LIMIT ?
+    """, (limit,))
+    return cur.fetchall()[::-1]
+
+
+def payment_totals(start: str, end: str, park_group_id: Optional[str] = None, status: str = "performed",
+                   by_day: bool = False) -> list:
+    """Count and sum of payments per park and category with ``start <= performed_at < end``.
+
+    ``start``/``end`` are ISO dates or timestamps (``"2025-01-01"``). Answered from
+    idx_park_status_performed / idx_status_performed alone, without touching the table.
+    Rows: ``{"park_group_id", "category_id", ["day",] "count", "amount"}`` with ``amount``
+    a Decimal in UZS.
+    """
+    day = "substr(performed_at, 1, 10)"
+    columns = f"park_group_id, category_id{', ' + day + ' AS day' if by_day else ''}"
+    where = "status = ? AND performed_at >= ? AND performed_at < ?"
+    params = [status, start, end]
+    if park_group_id is not None:
+        where = "park_group_id = ? AND " + where
+        params.insert(0, park_group_id)
+    cur = get_conn().execute(f"""
+        SELECT {columns}, COUNT(*) AS count, COALESCE(SUM(amount_tiyin), 0) AS amount_tiyin
+        FROM payments
+        WHERE {where}
+        GROUP BY {columns.replace(' AS day', '')}
+        ORDER BY {columns.replace(' AS day', '')}
+    """, params)
+    names = [c[0] for c in cur.description]
+    rows = []
+    for values in cur.fetchall():
+        row = dict(zip(names, values))
+        row["amount"] = (Decimal(row.pop("amount_tiyin")) / 100).quantize(Decimal("0.01"))
+        rows.append(row)
+    return rows
+
+
+def _fill_daily_totals(conn, since: str = "") -> int:
+    day = _ROLLUP_DAY.format(row="payments")
+    cur = conn.execute(f"""
+        INSERT INTO payment_daily_totals (day, park_group_id, provider, status, count, amount_tiyin, topup_tiyin)
+        SELECT {day}, COALESCE(park_group_id, ''), provider, status,
+               COUNT(*), COALESCE(SUM(amount_tiyin), 0), COALESCE(SUM(topup_tiyin), 0)
+        FROM payments
+        WHERE status IN ('performed', 'failed') AND {day} >= ?
+        GROUP BY 1, 2, 3, 4
+    """, (since,))
+    return cur.rowcount
+
+
+def rebuild_daily_totals(since: Optional[str] = None) -> int:
+    """Recompute payment_daily_totals from payments, for all days or those ``>= since``.
+
+    For backfills and after fixing rows by hand; the triggers keep it current otherwise.
+    Returns the number of buckets written.
+    """
+    since = (since or "")[:10]
+    with transaction() as conn:
+        conn.execute("DELETE FROM payment_daily_totals WHERE day >= ?", (since,))
+        return _fill_daily_totals(conn, since)
+
+
+def daily_totals(start: str, end: str, park_group_id: Optional[str] = None) -> list:
+    """Rows of payment_daily_totals for days ``start <= day < end`` (ISO dates).
+
+    Rows: ``{"day", "park_group_id", "provider", "status", "count", "amount", "topup"}``
+    with ``amount`` (received) and ``topup`` (credited to drivers) as Decimals in UZS.
+    """
+    where, params = "day >= ? AND day < ?", [start[:10], end[:10]]
+    if park_group_id is not None:
+        where += " AND park_group_id = ?"
+        params.append(park_group_id)
+    cur = get_conn().execute(f"""
+        SELECT day, park_group_id, provider, status, count, amount_tiyin, topup_tiyin
+        FROM payment_daily_totals
+        WHERE {where} AND count != 0
+        ORDER BY day, park_group_id, provider, status
+    """, params)
+    names = [c[0] for c in cur.description]
+    rows = []
+    for values in cur.fetchall():
+        row = dict(zip(names, values))
+        row["amount"] = (Decimal(row.pop("amount_tiyin")) / 100).quantize(Decimal("0.01"))
+        row["topup"] = (Decimal(row.pop("topup_tiyin")) / 100).quantize(Decimal("0.01"))
+        rows.append(row)
+    return rows
+
+
+def payments_missing_topup(park_group_id: str, limit: int = 1000) -> list:
+    """``(id, provider, amount)`` of performed payments of a park recorded before topup_tiyin existed."""
+    return get_conn().execute("""
+        SELECT id, provider, amount FROM payments
+        WHERE park_group_id = ? AND status = 'performed' AND topup_tiyin IS NULL
+        ORDER BY id
+        LIMIT ?
+    """, (park_group_id, limit)).fetchall()
+
+
+def set_topup_amounts(amounts: list) -> None:
+    """Store ``(payment_id, topup_tiyin)`` pairs; the update trigger moves the daily totals along."""
+    with transaction() as conn:
+        conn.executemany("UPDATE payments SET topup_tiyin = ? WHERE id = ?",
+                         [(topup_tiyin, payment_id) for payment_id, topup_tiyin in amounts])
+
+
+def _archive_path() -> str:
+    return ARCHIVE_DB_NAME or os.path.splitext(DB_NAME)[0] + "_archive.db"
+
+
+def _attach_archive(conn) -> None:
+    if any(row[1] == "archive" for row in conn.execute("PRAGMA database_list")):
+        return
+    conn.execute("ATTACH DATABASE ? AS archive", (_archive_path(),))
+    conn.execute("PRAGMA archive.journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS archive.payment_payloads (
+            payment_id INTEGER PRIMARY KEY,
+            payload BLOB NOT NULL,        -- zlib-compressed raw_payload JSON
+            archived_at TEXT NOT NULL
+        )
+    """)
+
+
+def archive_payloads(older_than_days: float, limit: int = 500) -> int:
+    """Move raw_payload of up to ``limit`` performed payments older than ``older_than_days`` to the archive.
+
+    The compressed copy is committed to the archive file first and only then cleared in
+    payments, so a crash in between leaves the payload in both places, never in neither.
+    Returns how many were moved; the freed pages are returned by ``incremental_vacuum()``.
+    """
+    conn = get_conn()
+    _attach_archive(conn)
+    rows = conn.execute("""
+        SELECT id, raw_payload FROM payments
+        WHERE status = 'performed' AND raw_payload IS NOT NULL AND performed_at < datetime('now', ?)
+        ORDER BY id
+        LIMIT ?
+    """, (f"-{float(older_than_days)} days", limit)).fetchall()
+    if not rows:
+        return 0
+    archived_at = datetime.utcnow().isoformat(timespec="seconds")
+    with transaction():
+        conn.executemany(
+            "INSERT OR REPLACE INTO archive.payment_payloads (payment_id, payload, archived_at) VALUES (?, ?, ?)",
+            [(payment_id, zlib.compress(payload.encode()), archived_at) for payment_id, payload in rows]
+        )
+    # Shrinking a row in place leaves its page as full as before; deleting and re-inserting the
+    # rows lets sqlite merge the emptied pages, which incremental_vacuum() can then hand back.
+    # The rollup triggers see a delete and an insert of the same row and cancel out.
+    ids = json.dumps([row[0] for row in rows])
+    with transaction():
+        conn.execute("""
+            CREATE TEMP TABLE archived_rows AS
+            SELECT * FROM payments WHERE id IN (SELECT value FROM json_each(?))
+        """, (ids,))
+        conn.execute("DELETE FROM payments WHERE id IN (SELECT id FROM archived_rows)")
+        conn.execute("UPDATE archived_rows SET raw_payload = NULL")
+        conn.execute("INSERT INTO payments SELECT * FROM archived_rows")
+        conn.execute("DROP TABLE temp.archived_rows")
+    return len(rows)
+
+
+def fetch_raw_payload(payment_id: int) -> Optional[dict]:
+    """raw_payload of a payment, from the payments row or, once archived, from the archive."""
+    conn = get_conn()
+    row = conn.execute("SELECT raw_payload FROM payments WHERE id = ?", (payment_id,)).fetchone()
+    if row is None:
+        return None
+    if row[0] is not None:
+        return json.loads(row[0])
+    _attach_archive(conn)
+    row = conn.execute("SELECT payload FROM archive.payment_payloads WHERE payment_id = ?", (payment_id,)).fetchone()
+    return json.loads(zlib.decompress(row[0])) if row else None
+
+
+def incremental_vacuum(pages: int = 1000) -> int:
+    """Give up to ``pages`` free pages back to the OS; returns how many free pages are left.
+
+    A no-op unless the file uses auto_vacuum=INCREMENTAL (see init_db()).
+    """
+    conn = get_conn()
+    conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+    return conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+
+def enable_incremental_vacuum() -> bool:
+    """Switch an existing file to auto_vacuum=INCREMENTAL; rewrites the whole file once.
+
+    Returns False if it already was. Takes an exclusive lock for the duration, so run it
+    with the bot stopped.
+    """
+    conn = get_conn()
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return False
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("VACUUM")
+    return True
+
+
+def load_checkpoints() -> dict:
+    return dict(get_conn().execute("SELECT group_id, last_message_id FROM group_checkpoints").fetchall())
+
+
+def save_checkpoints(checkpoints: dict) -> None:
+    """Upsert ``{group_id: last_message_id}``; a checkpoint never moves backwards."""
+    if not checkpoints:
+        return
+    updated_at = datetime.utcnow().isoformat(timespec="seconds")
+    with transaction() as conn:
+        conn.executemany("""
+            INSERT INTO group_checkpoints (group_id, last_message_id, updated_at) VALUES (?, ?, ?)
+            ON CONFLICT(group_id) DO UPDATE SET
+                last_message_id = MAX(last_message_id, excluded.last_message_id),
+                updated_at = excluded.updated_at
+        """, [(group_id, message_id, updated_at) for group_id, message_id in checkpoints.items()])
+
+
+def fetch_payment_statuses(payment_ids: list) -> dict:
+    """``{id: status}`` for the given payments."""
+    if not payment_ids:
+        return {}
+    placeholders = ",".join("?" * len(payment_ids))
+    cur = get_conn().execute(f"SELECT id, status FROM payments WHERE id IN ({placeholders})", tuple(payment_ids))
+    return dict(cur.fetchall())
+
+
+def assign_idempotency_token(payment_ids: list, token: str) -> None:
+    """Give still-'created' payments a shared token before they are topped up together."""
+    placeholders = ",".join("?" * len(payment_ids))
+    with transaction() as conn:
+        conn.execute(f"""
+            UPDATE payments SET idempotency_token = ?
+            WHERE status = 'created' AND id IN ({placeholders})
+        """, (token, *payment_ids))
+
+
+def count_payments_by_status(status: str, park_group_ids: Optional[list] = None) -> int:
+    parks, parks_params = _parks_filter(park_group_ids)
+    return get_conn().execute(f"SELECT COUNT(*) FROM payments WHERE status = ?{parks}",
+                              (status, *parks_params)).fetchone()[0]
+
+
+def save_drivers(park_id: str, drivers: list) -> None:
+    """Upsert ``(callsign, driver_profile_id, profile)`` rows for a park and mark them verified now."""
+    if not drivers:
+        return
+    verified_at = datetime.utcnow().isoformat(timespec="seconds")
+    rows = [
+        (park_id, callsign, driver_profile_id, json.dumps(profile, ensure_ascii=False), verified_at)
+        for callsign, driver_profile_id, profile in drivers
+    ]
+    with transaction() as conn:
+        conn.executemany("""
+            INSERT INTO drivers (park_id, callsign, driver_profile_id, profile, verified_at, invalid)
+            VALUES (?, ?, ?, ?, ?, 0)
+            ON CONFLICT(park_id, callsign) DO UPDATE SET
+                driver_profile_id = excluded.driver_profile_id,
+                profile = excluded.profile,
+                verified_at = excluded.verified_at,
+                invalid = 0
+        """, rows)
+
+
+def load_drivers(park_id: str) -> list:
+    """Valid cached drivers of a park as ``(profile, verified_at)`` tuples."""
+    cur = get_conn().execute(
+        "SELECT profile, verified_at FROM drivers WHERE park_id = ? AND invalid = 0",
+        (park_id,)
+    )
+    return [(json.loads(profile), verified_at) for profile, verified_at in cur.fetchall() if profile]
+
+
+def invalidate_driver(park_id: str, callsign: str) -> None:
+    get_conn().execute(
+        "UPDATE drivers SET invalid = 1 WHERE park_id = ? AND callsign = ?",
+        (park_id, callsign)
+    )
+
+
+def delete_drivers(park_id: str, callsigns: list) -> None:
+    if not callsigns:
+        return
+    with transaction() as conn:
+        conn.executemany(
+            "DELETE FROM drivers WHERE park_id = ? AND callsign = ?",
+            [(park_id, callsign) for callsign in callsigns]
+        )
+
+
+async def run_db(func, *args, **kwargs):
+    """Run a blocking DB function on the DB worker thread and await its result."""
+    loop = asyncio.get_running_loop()
+    with DB_SECONDS.time(op=func.__name__):
+        return await loop.run_in_executor(_DB_EXECUTOR, lambda: func(*args, **kwargs))
+
+
+async def close_db() -> None:
+    """Close the DB worker's connection (checkpointing the WAL) and stop the worker."""
+    await run_db(close_conn)
+    _DB_EXECUTOR.shutdown(wait=True)
+
+
+class StatusWriter:
+    """Group commit for payment status transitions.
+
+    Transitions are queued and written by one task in batches of up to ``max_batch``,
+    waiting at most ``max_delay`` seconds for a batch to fill, so a payout burst costs
+    one commit per batch instead of one per payment. Only status updates go through
+    here; the idempotency-guarding insert in ``save_payment`` is committed on its own.
+    """
+
+    def __init__(self, max_batch: int = 100, max_delay: float = 0.05):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: asyncio.Task | None = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def submit(self, payment_id: int, status: str, driver_profile_id: str = None,
+               performed_at: str = None, topup_tiyin: int = None) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(((payment_id, status, driver_profile_id, performed_at, topup_tiyin), future))
+        return future
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Write everything still queued, then stop."""
+        if self._task is None:
+            return
+        await self._queue.join()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _next_batch(self) -> list:
+        batch = [await self._queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.max_delay
+        while len(batch) < self.max_batch:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self) -> None:
+        while True:
+            batch = await self._next_batch()
+            try:
+                results = await run_db(update_payment_statuses, [update for update, _ in batch])
+            except Exception as e:
+                print("Status batch failed:", e)
+                results = [False] * len(batch)
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+                self._queue.task_done()
+
+
+status_writer = StatusWriter()
+
+
+async def save_payment_async(*args, **kwargs) -> Tuple[bool, dict, str]:
+    return await run_db(save_payment, *args, **kwargs)
+
+
+async def update_payment_status_async(payment_id: int, status: str, driver_profile_id: str = None,
+                                      performed_at: str = None, topup_tiyin: int = None,
+                                      wait: bool = False) -> bool:
+    """Queue a status transition on ``status_writer``; ``wait`` blocks until it is committed.
+
+    Without a running writer the update is written directly.
+    """
+    if not status_writer.running:
+        return await run_db(update_payment_status, payment_id, status, driver_profile_id, performed_at, topup_tiyin)
+    future = status_writer.submit(payment_id, status, driver_profile_id, performed_at, topup_tiyin)
+    if not wait:
+        return True
+    return await future
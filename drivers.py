@@ -0,0 +1,209 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+
+from database import run_db, save_drivers, load_drivers, invalidate_driver, delete_drivers
+
+logger = logging.getLogger(__name__)
+
+
+def callsign_key(callsign: str) -> str:
+    return (callsign or "").strip().upper()
+
+
+def driver_callsign(driver: dict) -> str:
+    car = driver.get("car") or {}
+    return callsign_key(car.get("callsign"))
+
+
+def driver_profile_id(driver: dict) -> str | None:
+    driver_profile = driver.get("driver_profile") or {}
+    return driver_profile.get("id") or driver.get("id")
+
+
+def _persist_rows(drivers: list) -> list:
+    rows = []
+    for driver in drivers:
+        key, driver_id = driver_callsign(driver), driver_profile_id(driver)
+        if key and driver_id:
+            rows.append((key, driver_id, driver))
+    return rows
+
+
+class DriverIndex:
+    """In-memory callsign -> driver profile index for one Yandex park.
+
+    ``build()`` pages through driver-profiles/list once; afterwards a background task
+    re-reads one page per ``refresh_interval`` and wraps around, so the whole park is
+    re-verified every ``pages * refresh_interval`` seconds without bursts against the
+    Fleet API rate limits.
+
+    Rules:
+      * an entry older than ``ttl`` is treated as a miss;
+      * a miss falls back to a live ``get_driver_by_callsign`` and the exact match is stored;
+        concurrent misses for one callsign share a single request, and a callsign the
+        API didn't find is answered from memory for ``negative_ttl`` seconds;
+      * a callsign that moved to another driver is overwritten by the newer page;
+      * callsigns not seen during a full refresh cycle are dropped (driver removed);
+      * ``invalidate()`` drops an entry, e.g. after a top-up against it failed;
+        ``mark_stale()`` additionally flags the persisted row so a restart won't reload it.
+
+    Every verified driver is also written to the ``drivers`` table; ``load_persisted()``
+    warms the index from it at startup, keeping the original verification times.
+    """
+
+    def __init__(self, api, *, ttl: float = 6 * 3600, refresh_interval: float = 30.0, page_size: int = 1000,
+                 negative_ttl: float = 30.0):
+        self.api = api
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.refresh_interval = refresh_interval
+        self.page_size = page_size
+
+        self._entries: dict[str, tuple[dict, float]] = {}
+        self._misses: dict[str, float] = {}
+        self._lookups: dict[str, asyncio.Future] = {}
+        self._offset = 0
+        self._cycle_started = time.monotonic()
+        self._task: asyncio.Task | None = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, callsign: str) -> dict | None:
+        entry = self._entries.get(callsign_key(callsign))
+        if not entry:
+            return None
+        driver, verified_at = entry
+        if time.monotonic() - verified_at > self.ttl:
+            return None
+        return driver
+
+    def put(self, driver: dict, verified_at: float | None = None) -> None:
+        key = driver_callsign(driver)
+        if key:
+            self._entries[key] = (driver, time.monotonic() if verified_at is None else verified_at)
+            self._misses.pop(key, None)
+
+    def invalidate(self, callsign: str) -> None:
+        self._entries.pop(callsign_key(callsign), None)
+
+    async def mark_stale(self, callsign: str) -> None:
+        self.invalidate(callsign)
+        await run_db(invalidate_driver, self.api.park_id, callsign_key(callsign))
+
+    async def load_persisted(self) -> int:
+        rows = await run_db(load_drivers, self.api.park_id)
+        now_wall, now_mono = datetime.utcnow(), time.monotonic()
+        for driver, verified_at in rows:
+            age = (now_wall - datetime.fromisoformat(verified_at)).total_seconds()
+            self.put(driver, now_mono - age)
+        return len(rows)
+
+    async def resolve(self, callsign: str) -> dict | None:
+        """Cached driver for ``callsign``, or a live Fleet API lookup on a miss.
+
+        Returns None when the park has no such driver; raises when the lookup itself failed.
+        """
+        if not callsign:
+            return None
+        driver = self.get(callsign)
+        if driver is not None:
+            return driver
+        key = callsign_key(callsign)
+        expires_at = self._misses.get(key)
+        if expires_at is not None:
+            if time.monotonic() < expires_at:
+                return None
+            del self._misses[key]
+        lookup = self._lookups.get(key)
+        if lookup is None:
+            lookup = asyncio.ensure_future(self._lookup(callsign))
+            self._lookups[key] = lookup
+            lookup.add_done_callback(lambda task: self._lookup_done(key, task))
+        # shield: a cancelled waiter must not cancel the request the others are sharing
+        return await asyncio.shield(lookup)
+
+    async def _lookup(self, callsign: str) -> dict | None:
+        # A failed request raises past the miss cache: only a real "no such driver" is cached
+        driver = await self.api.get_driver_by_callsign(callsign)
+        if driver is None:
+            self._misses[callsign_key(callsign)] = time.monotonic() + self.negative_ttl
+        elif driver_callsign(driver) == callsign_key(callsign):
+            self.put(driver)
+            await run_db(save_drivers, self.api.park_id, _persist_rows([driver]))
+        return driver
+
+    def _lookup_done(self, key: str, task: asyncio.Future) -> None:
+        self._lookups.pop(key, None)
+        if not task.cancelled():
+            task.exception()  # retrieved here in case every waiter was cancelled
+
+    async def _load_page(self, offset: int) -> int:
+        data = await self.api.list_driver_profiles(offset=offset, limit=self.page_size)
+        drivers = data.get("driver_profiles", []) or []
+        now = time.monotonic()
+        for driver in drivers:
+            self.put(driver, now)
+        await run_db(save_drivers, self.api.park_id, _persist_rows(drivers))
+        return len(drivers)
+
+    async def _prune(self, older_than: float) -> None:
+        stale = [key for key, (_, verified_at) in self._entries.items() if verified_at < older_than]
+        for key in stale:
+            del self._entries[key]
+        await run_db(delete_drivers, self.api.park_id, stale)
+
+    async def build(self) -> None:
+        """Full load of the park's driver list; failures leave the index to live lookups."""
+        started = time.monotonic()
+        offset = 0
+        try:
+            while True:
+                count = await self._load_page(offset)
+                offset += count
+                if count < self.page_size:
+                    break
+        except Exception as e:
+            logger.warning("driver index build failed for park %s: %s", self.api.park_id, e)
+            return
+        await self._prune(started)
+        logger.info("driver index for park %s: %d drivers", self.api.park_id, len(self._entries))
+
+    async def refresh_step(self) -> None:
+        count = await self._load_page(self._offset)
+        if count < self.page_size:
+            # End of the list: everything not seen during this cycle is gone from the park
+            await self._prune(self._cycle_started)
+            self._offset = 0
+            self._cycle_started = time.monotonic()
+        else:
+            self._offset += count
+
+    async def _refresh_loop(self, rebuild: bool) -> None:
+        if rebuild:
+            await self.build()
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.refresh_step()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("driver index refresh failed for park %s: %s", self.api.park_id, e)
+
+    def start(self, rebuild: bool = False) -> None:
+        """Start background refreshing; ``rebuild`` first re-runs the full build in the background."""
+        if self._task is None:
+            self._cycle_started = time.monotonic()
+            self._task = asyncio.create_task(self._refresh_loop(rebuild))
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
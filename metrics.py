@@ -0,0 +1,282 @@
+import asyncio
+import bisect
+import functools
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels_text(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def _samples(self) -> list:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        super().__init__(name, help_text, labelnames)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self) -> list:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_labels_text(self.labelnames, key)} {value}" for key, value in items]
+
+
+class Gauge(_Metric):
+    """Set directly, or read from ``set_function(fn)`` at scrape time."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        super().__init__(name, help_text, labelnames)
+        self._values: dict[tuple, float] = {}
+        self._function = None
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def set_function(self, function) -> None:
+        self._function = function
+
+    def _samples(self) -> list:
+        if self._function is not None:
+            try:
+                return [f"{self.name} {float(self._function())}"]
+            except Exception as e:
+                logger.warning("gauge %s failed: %s", self.name, e)
+                return []
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_labels_text(self.labelnames, key)} {value}" for key, value in items]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per-bucket counts..., +Inf count, sum]
+        self._values: dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels) if self.labelnames else ()
+        # Index of the first bound >= value; len(buckets) is the +Inf bucket
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[i] += 1
+            state[-1] += value
+
+    def count(self, **labels) -> int:
+        state = self._values.get(self._key(labels))
+        return sum(state[:-1]) if state else 0
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _samples(self) -> list:
+        with self._lock:
+            items = [(key, list(state)) for key, state in self._values.items()]
+        lines = []
+        for key, state in items:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), state):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_labels_text(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels_text(self.labelnames, key)} {state[-1]}")
+            lines.append(f"{self.name}_count{_labels_text(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: list[_Metric] = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self._metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def timed(histogram: Histogram, labels=None, **static_labels):
+    """Decorator observing the wrapped function's duration (sync or async) on ``histogram``.
+
+    ``labels`` is an optional callable given the call's arguments and returning extra
+    label values, e.g. ``lambda self, *a, **kw: {"park": self.park_id}``.
+    """
+
+    def decorate(func):
+        def label_values(args, kwargs) -> dict:
+            if labels is None:
+                return static_labels
+            return {**static_labels, **labels(*args, **kwargs)}
+
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with histogram.time(**label_values(args, kwargs)):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        if labels is None and not static_labels:
+            # Hot sync paths (the parser): no label work and no context manager per call
+            @functools.wraps(func)
+            def plain_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - started)
+            return plain_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**label_values(args, kwargs)):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorate
+
+
+# === Bot metrics ===
+MESSAGES = REGISTRY.register(Counter(
+    "bot_messages_total", "Payment group messages by stage (seen, parsed, ignored)", ("park", "provider", "stage")))
+PAYMENTS = REGISTRY.register(Counter(
+    "bot_payments_total", "Payment outcomes by result and reason", ("park", "provider", "result", "reason")))
+
+PARSE_SECONDS = REGISTRY.register(Histogram(
+    "bot_parse_seconds", "Time to parse one payment message",
+    buckets=(0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.005)))
+DB_SECONDS = REGISTRY.register(Histogram(
+    "bot_db_seconds", "Time of one DB call on the DB worker thread, queueing included", ("op",)))
+DRIVER_LOOKUP_SECONDS = REGISTRY.register(Histogram(
+    "bot_driver_lookup_seconds", "Live Fleet API driver lookup by callsign", ("park",)))
+TOPUP_SECONDS = REGISTRY.register(Histogram(
+    "bot_topup_seconds", "Fleet API top-up transaction", ("park",)))
+YANDEX_REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "bot_yandex_request_seconds", "Fleet API request including retries and limiter waits", ("park",)))
+TELEGRAM_SEND_SECONDS = REGISTRY.register(Histogram(
+    "bot_telegram_send_seconds", "Bot API sendMessage including 429 waits"))
+PAYMENT_SECONDS = REGISTRY.register(Histogram(
+    "bot_payment_seconds", "Message received to payment finished", ("park",)))
+
+IN_FLIGHT = REGISTRY.register(Gauge("bot_in_flight_payments", "Payments queued or running in this process"))
+CREATED_BACKLOG = REGISTRY.register(Gauge("bot_created_backlog", "Payments in 'created' at the last recovery pass"))
+PAYMENT_QUEUE = REGISTRY.register(Gauge("bot_payment_queue", "Payment messages waiting for a worker"))
+TOPUP_QUEUE = REGISTRY.register(Gauge("bot_topup_queue", "Payments waiting in per-driver top-up queues"))
+NOTIFY_QUEUE = REGISTRY.register(Gauge("bot_notify_queue", "Telegram notifications waiting to be sent"))
+
+
+class MetricsServer:
+    """Serves ``GET /metrics`` in the Prometheus text format on a local port.
+
+    With a ``health`` callable returning ``(ok, details)`` it also answers ``GET /healthz``:
+    200 or 503 with ``details`` as JSON.
+    """
+
+    def __init__(self, registry: Registry = REGISTRY, *, host: str = "127.0.0.1", port: int = 9108,
+                 health=None):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.health = health
+        self._server: asyncio.base_events.Server | None = None
+
+    async def start(self) -> None:
+        if self._server is None and self.port:
+            self._server = await asyncio.start_server(self._handle, self.host, self.port)
+            logger.info("metrics on http://%s:%d/metrics", self.host, self.port)
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    def _route(self, path: str) -> tuple[str, str, str]:
+        if path == "/metrics":
+            return "200 OK", "text/plain; version=0.0.4", self.registry.render()
+        if path == "/healthz" and self.health is not None:
+            ok, details = self.health()
+            status = "200 OK" if ok else "503 Service Unavailable"
+            return status, "application/json", json.dumps({"ok": ok, **details}) + "\n"
+        return "404 Not Found", "text/plain", "not found\n"
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split()
+            path = parts[1].split("?", 1)[0] if len(parts) > 1 else "/"
+            status, content_type, body = self._route(path)
+            data = body.encode()
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: {content_type}; charset=utf-8\r\n"
+                f"Content-Length: {len(data)}\r\n"
+                f"Connection: close\r\n\r\n".encode() + data
+            )
+            await writer.drain()
+        except Exception as e:
+            logger.warning("metrics request failed: %s", e)
+        finally:
+            writer.close()
@@ -1,32 +1,56 @@
 import re
 from decimal import Decimal, InvalidOperation
 
+from metrics import PARSE_SECONDS, timed
+
+_CALLSIGN = r"[0-9A-Za-z\-]+"
+
+# Each field is found by its own search anchored on a literal marker (🇺🇿, 🧾, 🆔, 🔸, ➡️),
+# which re scans for in C before trying the rest of the pattern; that is much cheaper
+# than one alternation tried at every position. Patterns, first-match rules and the
+# callsign priority are those of the original per-field parsers.
 AMOUNT_RE = re.compile(r"🇺🇿\s*([^\n]+)")
-TXN_RE = re.compile(r"🆔\s*([0-9a-fA-F]+)|🧾\s*(\d+)")
-PAYMENT_ID_RE = re.compile(r"🧾\s*(\d+)")
-DRIVER_RE_VARIANTS = [
-    re.compile(r"🔸\s*Id водителя:\s*([0-9A-Za-z\-]+)", re.IGNORECASE),
-    re.compile(r"🔸\s*ID водителя:\s*([0-9A-Za-z\-]+)", re.IGNORECASE),
-    re.compile(r"🔸\s*Позывной водителя:\s*([0-9A-Za-z\-]+)", re.IGNORECASE),
-    re.compile(r"🔸\s*Позывной:\s*([0-9A-Za-z\-]+)", re.IGNORECASE),
-    re.compile(r"ID водителя:\s*([0-9A-Za-z\-]+)", re.IGNORECASE),
-    re.compile(r"Позывной водителя:\s*([0-9A-Za-z\-]+)", re.IGNORECASE),
-    re.compile(r"➡️\s*Параметры оплаты:\s*([0-9A-Za-z\-]+)", re.IGNORECASE),
-    re.compile(r"➡️\s*Параметры оплаты:\s*\n\s*🔸\s*([0-9A-Za-z\-]+)", re.IGNORECASE),
-]
+RECEIPT_RE = re.compile(r"🧾\s*(\d+)")
+TXN_RE = re.compile(r"🆔\s*([0-9a-fA-F]+)")
+AMOUNT_JUNK_RE = re.compile(r"[^\d,\.]")
+# Comma followed by exactly 3 digits; a lookahead so the substitution is a plain deletion
+THOUSANDS_SEP_RE = re.compile(r",(?=\d{3})")
 
+# Callsign patterns, highest priority first, each with a literal its match must contain;
+# a pattern is only searched when that literal is in the text ("" means always)
+CALLSIGN_RES = (
+    ("🔸", re.compile(rf"🔸\s*Id водителя:\s*({_CALLSIGN})", re.IGNORECASE)),
+    ("🔸", re.compile(rf"🔸\s*Позывной водителя:\s*({_CALLSIGN})", re.IGNORECASE)),
+    ("🔸", re.compile(rf"🔸\s*Позывной:\s*({_CALLSIGN})", re.IGNORECASE)),
+    ("", re.compile(rf"ID водителя:\s*({_CALLSIGN})", re.IGNORECASE)),
+    ("", re.compile(rf"Позывной водителя:\s*({_CALLSIGN})", re.IGNORECASE)),
+    ("➡️", re.compile(rf"➡️\s*Параметры оплаты:\s*({_CALLSIGN})", re.IGNORECASE)),
+    ("➡️", re.compile(rf"➡️\s*Параметры оплаты:\s*\n\s*🔸\s*({_CALLSIGN})", re.IGNORECASE)),
+)
 
-def parse_amount(text: str) -> Decimal:
-    if not text:
-        return Decimal("0")
-    m = AMOUNT_RE.search(text)
-    if not m:
+
+class ParsedMessage:
+    __slots__ = ("amount", "provider_txn_id", "callsign", "success")
+
+    def __init__(self, amount: Decimal, provider_txn_id: str | None, callsign: str | None, success: bool):
+        self.amount = amount
+        self.provider_txn_id = provider_txn_id
+        self.callsign = callsign
+        self.success = success
+
+    def __repr__(self):
+        return (f"ParsedMessage(amount={self.amount!r}, provider_txn_id={self.provider_txn_id!r}, "
+                f"callsign={self.callsign!r}, success={self.success!r})")
+
+
+def _amount_from_raw(raw: str | None) -> Decimal:
+    if raw is None:
         return Decimal("0")
-    raw = m.group(1)
     # Remove non-digit except comma/dot
-    clean = re.sub(r"[^\d,\.]", "", raw)
+    clean = AMOUNT_JUNK_RE.sub("", raw)
     # Remove thousands separators (comma followed by exactly 3 digits)
-    clean = re.sub(r",(\d{3})", r"\1", clean)
+    if "," in clean:
+        clean = THOUSANDS_SEP_RE.sub("", clean)
     # Replace remaining comma (decimal separator) with dot
     clean = clean.replace(",", ".")
     try:
@@ -35,34 +59,43 @@ def parse_amount(text: str) -> Decimal:
         return Decimal("0")
 
 
-def parse_provider_txn_id(text: str) -> str | None:
-    # Prefer 🧾 numeric id as provider transaction id (payment receipt)
-    m = PAYMENT_ID_RE.search(text)
-    if m:
-        return m.group(1)
-    # fallback to 🆔 alphanumeric id
-    m2 = re.search(r"🆔\s*([0-9a-fA-F]+)", text)
-    if m2:
-        return m2.group(1)
+def _callsign(text: str) -> str | None:
+    for marker, pattern in CALLSIGN_RES:
+        if marker in text:
+            m = pattern.search(text)
+            if m:
+                return m.group(1).strip()
     return None
 
 
-def parse_callsign(text: str) -> str | None:
+@timed(PARSE_SECONDS)
+def parse_message(text: str) -> ParsedMessage:
+    """Amount, provider txn id, callsign and success flag of a payment message."""
     if not text:
-        return None
-    for rx in DRIVER_RE_VARIANTS:
-        m = rx.search(text)
-        if m:
-            return m.group(1).strip()
-    return None
+        return ParsedMessage(Decimal("0"), None, None, False)
+
+    amount = AMOUNT_RE.search(text)
+    # Prefer 🧾 numeric id as provider transaction id (payment receipt), fall back to 🆔
+    txn = RECEIPT_RE.search(text) or TXN_RE.search(text)
+    return ParsedMessage(
+        amount=_amount_from_raw(amount.group(1) if amount else None),
+        provider_txn_id=txn.group(1) if txn else None,
+        callsign=_callsign(text),
+        success="Успешно" in text and ("оплачен" in text or "подтвержден" in text),
+    )
+
+
+def parse_amount(text: str) -> Decimal:
+    return parse_message(text).amount
+
+
+def parse_provider_txn_id(text: str) -> str | None:
+    return parse_message(text).provider_txn_id
+
+
+def parse_callsign(text: str) -> str | None:
+    return parse_message(text).callsign
 
 
 def is_successful_payment(text: str) -> bool:
-    if not text:
-        return False
-    return (
-        "Успешно оплачен" in text
-        or ("Успешно" in text and "оплачен" in text)
-        or "Успешно подтвержден" in text
-        or ("Успешно" in text and "подтвержден" in text)
-    )
+    return parse_message(text).success
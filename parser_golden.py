@@ -0,0 +1,102 @@
+"""Golden corpus for parser.parse_message.
+
+Payme and Click group message layouts the parser has to keep handling, with the values
+the original per-field parsers returned for them. Run ``python parser_golden.py`` after
+touching parser.py; it exits non-zero on any difference.
+"""
+import sys
+from decimal import Decimal
+
+from parser import parse_message
+
+# name, message text, (amount, provider_txn_id, callsign, success)
+GOLDEN = [
+    (
+        "payme_paid_bullet_callsign",
+        "✅ Успешно оплачен\n\n🆔 66f1c2a9b3e4d5f6a7b8c9d0\n🧾 4183920571\n🇺🇿 150,000.00 сум\n\n➡️ Параметры оплаты:\n🔸 Позывной водителя: 10245",
+        (Decimal("150000.00"), "4183920571", "10245", True),
+    ),
+    (
+        "payme_paid_params_next_line",
+        "✅ Успешно оплачен\n🆔 6700aa11bb22cc33dd44ee55\n🇺🇿 75,500.00 сум\n➡️ Параметры оплаты:\n🔸 7781",
+        (Decimal("75500.00"), "6700aa11bb22cc33dd44ee55", "7781", True),
+    ),
+    (
+        "payme_paid_params_inline",
+        "Успешно оплачен ✅\n🆔 67a0ff00ee11dd22cc33bb44\n🇺🇿 1,250,000.00 UZS\n➡️ Параметры оплаты: TX-402",
+        (Decimal("1250000.00"), "67a0ff00ee11dd22cc33bb44", "TX-402", True),
+    ),
+    (
+        "payme_cancelled",
+        "❌ Платёж отменён\n🆔 66ee00112233445566778899\n🇺🇿 20,000.00 сум\n➡️ Параметры оплаты:\n🔸 Позывной водителя: 10245",
+        (Decimal("20000.00"), "66ee00112233445566778899", "10245", False),
+    ),
+    (
+        "click_confirmed_driver_id",
+        "✅ Успешно подтвержден\n🧾 2957310648\n🇺🇿 50 000,00 сум\n🔸 ID водителя: A-1021",
+        (Decimal("50000.00"), "2957310648", "A-1021", True),
+    ),
+    (
+        "click_confirmed_id_lowercase",
+        "Платеж Успешно подтвержден\n🧾 2957310700\n🇺🇿 12 345,50\n🔸 Id водителя: b77",
+        (Decimal("12345.50"), "2957310700", "b77", True),
+    ),
+    (
+        "click_confirmed_short_callsign",
+        "✅ Успешно подтвержден\n🧾 2957311002\n🇺🇿 300 000 сум\n🔸 Позывной: 5521",
+        (Decimal("300000"), "2957311002", "5521", True),
+    ),
+    (
+        "click_plain_labels",
+        "Успешно подтвержден\n🧾 2957312000\n🇺🇿 99 000,00 сум\nID водителя: 3001\nПозывной водителя: 3002",
+        (Decimal("99000.00"), "2957312000", "3001", True),
+    ),
+    (
+        "click_pending",
+        "⏳ Ожидает подтверждения\n🧾 2957313001\n🇺🇿 40 000,00 сум\n🔸 ID водителя: 8810",
+        (Decimal("40000.00"), "2957313001", "8810", False),
+    ),
+    (
+        "receipt_preferred_over_txn",
+        "✅ Успешно оплачен\n🆔 deadbeef\n🧾 555000111\n🇺🇿 10,000.00 сум\n🔸 Позывной водителя: 42",
+        (Decimal("10000.00"), "555000111", "42", True),
+    ),
+    (
+        "decimal_comma_amount",
+        "✅ Успешно оплачен\n🧾 1000001\n🇺🇿 1 500,75 сум\n🔸 Позывной: Z9",
+        (Decimal("1500.75"), "1000001", "Z9", True),
+    ),
+    (
+        "amount_on_next_line",
+        "✅ Успешно оплачен\n🧾 1000002\n🇺🇿\n25,000.00 сум\n🔸 Позывной: 17",
+        (Decimal("25000.00"), "1000002", "17", True),
+    ),
+    (
+        "no_markers",
+        "Salom! Bugun to'lovlar kechikishi mumkin.",
+        (Decimal("0"), None, None, False),
+    ),
+    (
+        "empty",
+        "",
+        (Decimal("0"), None, None, False),
+    ),
+]
+
+
+def check() -> list[str]:
+    failures = []
+    for name, text, expected in GOLDEN:
+        parsed = parse_message(text)
+        got = (parsed.amount, parsed.provider_txn_id, parsed.callsign, parsed.success)
+        if got != expected:
+            failures.append(f"{name}: expected {expected}, got {got}")
+    return failures
+
+
+if __name__ == "__main__":
+    failures = check()
+    for failure in failures:
+        print("❌", failure)
+    print(f"{len(GOLDEN) - len(failures)}/{len(GOLDEN)} golden messages OK")
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,42 @@
+"""Rebuild the payment_daily_totals rollup from the payments table.
+
+Performed payments saved before topup_tiyin was recorded first get it filled in
+from their park's current PAYMENT_FEE (an estimate if the fee changed since),
+then the daily totals are recomputed for every day, or from SINCE on.
+
+Usage: python rebuild_daily_totals.py [SINCE]   (SINCE as YYYY-MM-DD)
+"""
+import sys
+from decimal import Decimal
+
+import database
+from config import PARKS
+from utils import _apply_provider_fee
+
+
+def backfill_topups(park) -> int:
+    filled = 0
+    while True:
+        rows = database.payments_missing_topup(park.name)
+        if not rows:
+            return filled
+        database.set_topup_amounts([
+            (payment_id, database.to_tiyin(_apply_provider_fee(provider, Decimal(amount), park)))
+            for payment_id, provider, amount in rows
+        ])
+        filled += len(rows)
+
+
+def main(since: str = None) -> None:
+    database.init_db()
+    for park in PARKS.values():
+        filled = backfill_topups(park)
+        if filled:
+            print(f"{park.name}: top-up amount filled in for {filled} payments")
+    buckets = database.rebuild_daily_totals(since)
+    print(f"payment_daily_totals: {buckets} buckets rebuilt" + (f" from {since}" if since else ""))
+    database.close_conn()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else None)
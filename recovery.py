@@ -0,0 +1,170 @@
+import asyncio
+import logging
+
+from database import (run_db, fetch_payments_by_status, reopen_token_groups, fetch_payment_statuses,
+                      count_payments_by_status)
+from utils import TopupJob, schedule_topup, in_flight_payments
+
+logger = logging.getLogger(__name__)
+
+
+class PaymentRecovery:
+    """Finishes payments left in ``created``, e.g. when the process died mid top-up.
+
+    Runs once at startup and then every ``interval`` seconds. Only rows older than
+    ``min_age`` (and not being processed by this process) are picked up, so a payment
+    whose Yandex calls are still running is never retried underneath it. Each retry
+    re-resolves the driver and tops up with the payment's stable idempotency token, so
+    Yandex drops the top-up if the original attempt had actually gone through. Payments
+    that were combined into one top-up share a token and are replayed together.
+
+    Only payments of ``parks`` are fetched, so rows of a park removed by a reload (or
+    served by another worker) never fill a batch. Passes page through the backlog by id
+    and wrap around after a short page, so rows that keep being skipped or failing (open
+    circuit) don't hold back the ones behind them. ``own_parks_only`` limits ``backlog``
+    to ``parks`` too, for workers that each serve a share of the parks.
+    """
+
+    def __init__(self, parks: dict, *, interval: float = 60.0, min_age: float = 300.0,
+                 per_park_concurrency: int = 2, batch_size: int = 200, own_parks_only: bool = False):
+        self.own_parks_only = own_parks_only
+        self.update_parks(parks)
+        self.interval = interval
+        self.min_age = min_age
+        self.per_park_concurrency = per_park_concurrency
+        self.batch_size = batch_size
+
+        self.backlog = 0
+        self._limits: dict[str, asyncio.Semaphore] = {}
+        self._task: asyncio.Task | None = None
+        self._wake = asyncio.Event()
+        self._wake_min_age: float | None = None
+        self._more = False
+        self._last_id = 0
+
+    def update_parks(self, parks: dict) -> None:
+        """Serve ``parks`` from the next pass on (after a config reload)."""
+        self.parks_by_name = {park.name: park for park in parks.values()}
+        self.park_names = list(self.parks_by_name) if self.own_parks_only else None
+
+    def _limit(self, park_name: str) -> asyncio.Semaphore:
+        if park_name not in self._limits:
+            self._limits[park_name] = asyncio.Semaphore(self.per_park_concurrency)
+        return self._limits[park_name]
+
+    def _job(self, row: dict) -> TopupJob | None:
+        park = self.parks_by_name.get(row["park_group_id"])
+        if park is None:
+            logger.warning("recovery: payment %s belongs to unknown park %r", row["id"], row["park_group_id"])
+            return None
+        return TopupJob.from_row(row, park)
+
+    async def _units(self, rows: list) -> list:
+        """Single payments, plus the members of each combined top-up grouped under their shared token."""
+        jobs = [job for job in map(self._job, rows) if job]
+        groups: dict[str, list] = {}
+        units = []
+        for job in jobs:
+            if job.batched:
+                groups.setdefault(job.token, [])
+            else:
+                units.append([job])
+        if groups:
+            # The batch limit may have cut a group, and members may have failed with it: a
+            # combined top-up is only ever replayed as the whole group, for the same total
+            for row in await run_db(reopen_token_groups, list(groups)):
+                groups[row["idempotency_token"]].append(self._job(row))
+            for members in groups.values():
+                if members and None not in members and not any(job.payment_id in in_flight_payments
+                                                               for job in members):
+                    units.append(members)
+        return units
+
+    async def _retry(self, unit: list) -> bool:
+        park = unit[0].park
+        # Counted from before the wait, so a reload doesn't close the client under this unit
+        park.in_flight += 1
+        try:
+            async with self._limit(park.name):
+                if any(job.payment_id in in_flight_payments for job in unit):
+                    return False
+                # The rows may have been finished by a live worker since this pass read them
+                statuses = await run_db(fetch_payment_statuses, [job.payment_id for job in unit])
+                if any(statuses.get(job.payment_id) != "created" for job in unit):
+                    return False
+                ok, msg = await schedule_topup(unit)
+                for job in unit:
+                    logger.info("recovery: payment %s (%s) -> ok=%s, %s", job.payment_id, job.provider_txn_id,
+                                ok, msg)
+                return ok
+        finally:
+            park.in_flight -= 1
+
+    async def run_once(self, min_age: float | None = None, after_id: int = 0) -> int:
+        """Retry one batch of stuck payments with ids above ``after_id``; returns how many went through.
+
+        Afterwards ``_more`` says whether the batch was full and ``_last_id`` where the next
+        one starts, whatever this pass had to skip (in flight here, still failing).
+        """
+        self.backlog = await run_db(count_payments_by_status, "created", self.park_names)
+        min_age = self.min_age if min_age is None else min_age
+        rows = await run_db(fetch_payments_by_status, "created", min_age, self.batch_size,
+                            list(self.parks_by_name), after_id)
+        self._more = len(rows) >= self.batch_size
+        self._last_id = rows[-1]["id"] if rows else after_id
+        rows = [row for row in rows if row["id"] not in in_flight_payments]
+        units = await self._units(rows)
+        if not units:
+            return 0
+        logger.warning("recovery: %d payments in 'created', retrying %d", self.backlog, len(rows))
+        results = await asyncio.gather(*(self._retry(unit) for unit in units), return_exceptions=True)
+        for unit, result in zip(units, results):
+            if isinstance(result, Exception):
+                logger.error("recovery: payment %s failed: %s", unit[0].payment_id, result)
+        self.backlog = await run_db(count_payments_by_status, "created", self.park_names)
+        return sum(1 for result in results if result is True)
+
+    def wake(self, min_age: float | None = None) -> None:
+        """Run the next pass now instead of after ``interval``, optionally with a different ``min_age``."""
+        self._wake_min_age = min_age
+        self._wake.set()
+
+    async def _loop(self) -> None:
+        min_age = None
+        after_id = 0
+        while True:
+            try:
+                await self.run_once(min_age, after_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("recovery run failed: %s", e)
+                self._more = False
+            # The next pass starts after this one's last row, or from the oldest after a short page
+            after_id = self._last_id if self._more else 0
+            if min_age is not None and self._more:
+                # A woken pass pages on through the backlog once; rows it skipped or couldn't
+                # finish wait for the next pass instead of being fetched again right away
+                continue
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            if self._wake.is_set():
+                # A wake starts a fresh sweep from the oldest row
+                after_id = 0
+            min_age, self._wake_min_age = self._wake_min_age, None
+            self._wake.clear()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
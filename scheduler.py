@@ -0,0 +1,91 @@
+import asyncio
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class KeyedScheduler:
+    """Runs work in order per key and in parallel across keys.
+
+    ``submit(key, unit)`` appends ``unit`` to the key's queue and returns a future with the
+    handler's result. Each key with queued work has one worker task, which exits once the
+    queue is empty, so idle keys cost nothing.
+
+    With ``batch_window > 0`` a worker waits that long before taking work off its queue,
+    then hands the handler up to ``max_batch`` consecutive units for which
+    ``can_merge(first, other)`` holds; every merged unit's future gets the same result.
+    """
+
+    def __init__(self, handler, *, batch_window: float = 0.0, max_batch: int = 1, can_merge=None):
+        self.handler = handler
+        self.batch_window = batch_window
+        self.max_batch = max(1, max_batch)
+        self.can_merge = can_merge or (lambda first, other: False)
+
+        self._queues: dict[object, deque] = {}
+        self._workers: dict[object, asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    @property
+    def active_keys(self) -> int:
+        return len(self._workers)
+
+    def submit(self, key, unit) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(key, deque()).append((unit, future))
+        if key not in self._workers:
+            self._workers[key] = asyncio.create_task(self._run(key))
+        return future
+
+    def _take(self, queue: deque) -> list:
+        taken = [queue.popleft()]
+        first = taken[0][0]
+        if self.batch_window <= 0:
+            return taken
+        while queue and len(taken) < self.max_batch and self.can_merge(first, queue[0][0]):
+            taken.append(queue.popleft())
+        return taken
+
+    async def _run(self, key) -> None:
+        queue = self._queues[key]
+        try:
+            while queue:
+                if self.batch_window > 0 and self.max_batch > 1 and len(queue) < self.max_batch:
+                    await asyncio.sleep(self.batch_window)
+                taken = self._take(queue)
+                units = [unit for unit, _ in taken]
+                try:
+                    result = await self.handler(units)
+                except asyncio.CancelledError:
+                    for _, future in taken:
+                        future.cancel()
+                    raise
+                except Exception as e:
+                    logger.error("scheduled work for %r failed: %s", key, e)
+                    for _, future in taken:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                for _, future in taken:
+                    if not future.done():
+                        future.set_result(result)
+        finally:
+            for _, future in queue:
+                future.cancel()
+            self._queues.pop(key, None)
+            self._workers.pop(key, None)
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """Let queued work finish for up to ``timeout`` seconds, then cancel the rest."""
+        workers = list(self._workers.values())
+        if not workers:
+            return
+        done, pending = await asyncio.wait(workers, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        if pending:
+            logger.warning("scheduler stopped with %d keys still busy", len(pending))
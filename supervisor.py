@@ -0,0 +1,108 @@
+"""Runs the bot as several processes, each serving its share of the parks.
+
+Every worker is ``telegram_api.py`` started with WORKER_INDEX / WORKER_COUNT, loads only
+the parks dealt to it (config.load_parks_from_env) and listens to their groups only. All
+workers share payment_bot.db: the UNIQUE (provider, provider_txn_id) row written before
+any top-up, and its stable idempotency token, stay the one guard against paying twice.
+Each worker has its own Telegram session and its own /metrics and /healthz on
+METRICS_PORT + index. A worker that exits is restarted with a growing delay; SIGHUP is
+passed on to every worker so they reload their parks.
+
+Usage: python supervisor.py [workers]   (default WORKER_COUNT, at most one per Yandex park)
+"""
+import asyncio
+import os
+import signal
+import sys
+
+import config
+import database
+
+# A worker that ran this long before dying is restarted right away again
+STABLE_AFTER = 60.0
+MAX_RESTART_DELAY = 60.0
+
+
+def _yandex_parks() -> int:
+    # Counted from the environment: config.PARKS of this process may already be one share
+    park_ids, idx = set(), 1
+    while os.getenv(f"PARK{idx}_NAME"):
+        park_ids.add(os.getenv(f"PARK{idx}_PARK_ID"))
+        idx += 1
+    return len(park_ids)
+
+
+class Worker:
+    def __init__(self, index: int, count: int):
+        self.index = index
+        self.count = count
+        self.process: asyncio.subprocess.Process | None = None
+        self.restarts = 0
+
+    async def run(self, stopping: asyncio.Event) -> None:
+        env = {**os.environ, "WORKER_INDEX": str(self.index), "WORKER_COUNT": str(self.count)}
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "telegram_api.py")
+        loop = asyncio.get_running_loop()
+        while not stopping.is_set():
+            started = loop.time()
+            self.process = await asyncio.create_subprocess_exec(sys.executable, script, env=env)
+            print(f"🧩 worker {self.index} started (pid {self.process.pid})")
+            code = await self.process.wait()
+            if stopping.is_set():
+                break
+            if loop.time() - started >= STABLE_AFTER:
+                self.restarts = 0
+            delay = min(MAX_RESTART_DELAY, 2 ** self.restarts)
+            self.restarts += 1
+            print(f"⚠️ worker {self.index} exited with {code}, restarting in {delay:.0f} s")
+            try:
+                await asyncio.wait_for(stopping.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def signal(self, sig: int) -> None:
+        if self.process is not None and self.process.returncode is None:
+            self.process.send_signal(sig)
+
+    async def stop(self, timeout: float) -> None:
+        process = self.process
+        if process is None or process.returncode is not None:
+            return
+        process.send_signal(signal.SIGTERM)
+        try:
+            await asyncio.wait_for(process.wait(), timeout)
+        except asyncio.TimeoutError:
+            print(f"⚠️ worker {self.index} did not stop in {timeout:.0f} s, killing it")
+            process.kill()
+            await process.wait()
+
+
+async def main(count: int) -> None:
+    # Schema and migrations once, before several processes open the file
+    database.init_db()
+    database.close_conn()
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+
+    workers = [Worker(index, count) for index in range(count)]
+
+    def forward(sig: int) -> None:
+        for worker in workers:
+            worker.signal(sig)
+
+    loop.add_signal_handler(signal.SIGHUP, forward, signal.SIGHUP)
+    tasks = [asyncio.create_task(worker.run(stopping)) for worker in workers]
+    await stopping.wait()
+    print("🛑 stopping workers...")
+    # Workers drain their payment queues on SIGTERM (see telegram_api.main)
+    await asyncio.gather(*(worker.stop(config.PAYMENT_DRAIN_TIMEOUT + 10) for worker in workers))
+    await asyncio.gather(*tasks)
+
+
+if __name__ == "__main__":
+    requested = int(sys.argv[1]) if len(sys.argv) > 1 else config.WORKER_COUNT
+    # More workers than Yandex parks would leave some without groups
+    asyncio.run(main(max(1, min(requested, _yandex_parks()))))
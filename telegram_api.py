@@ -1,23 +1,155 @@
 import asyncio
+import os
+import signal
+import time
+from functools import partial
 from decimal import Decimal
-from pyrogram import Client, filters
+from pyrogram import Client, filters, idle
 
 import config
-from config import PARKS
-from parser import parse_amount, parse_callsign, parse_provider_txn_id, is_successful_payment
-from telegram_notification import notify_payment_error
-from utils import save_payment_and_topup, _get_category_id
-from database import init_db
+from parser import parse_message
+from telegram_notification import notify_payment_error, notify_circuit_state, dispatcher
+from utils import (save_payment_and_topup, save_payment_for_recovery, _get_category_id, topup_scheduler,
+                   in_flight_payments, already_performed, warm_performed_txns)
+from database import init_db, close_db, status_writer
+from recovery import PaymentRecovery
+from archive import PayloadArchiver
+from catchup import GroupCheckpoints, catch_up
+from workqueue import WorkQueue
+import metrics
 
 # initialize DB
 init_db()
 
+
+
+def _notify_circuit_state(parks, breaker, old_state, new_state) -> None:
+    chats = set()
+    for park in parks:
+        chat = park.notification_chat_id or getattr(config, "TELEGRAM_CHAT_ID", "")
+        if chat not in chats:
+            chats.add(chat)
+            notify_circuit_state(park, breaker, old_state, new_state)
+
+
+def _watch_breakers(parks) -> None:
+    # Operators hear about it in the park chat when Yandex calls for a park are suspended;
+    # a client (and its breaker) is shared by every entry with the same credentials
+    sharing = {}
+    for park in parks.values():
+        sharing.setdefault(id(park.api), (park.api, []))[1].append(park)
+    for api, users in sharing.values():
+        api.breaker.on_change = partial(_notify_circuit_state, users)
+
+
+_watch_breakers(config.PARKS)
+
+recovery = PaymentRecovery(
+    config.PARKS,
+    interval=config.RECOVERY_INTERVAL,
+    min_age=config.RECOVERY_MIN_AGE,
+    per_park_concurrency=config.RECOVERY_PARK_CONCURRENCY,
+    batch_size=config.RECOVERY_BATCH_SIZE,
+    own_parks_only=config.WORKER_COUNT > 1,
+)
+
+checkpoints = GroupCheckpoints(flush_interval=config.CHECKPOINT_FLUSH_INTERVAL)
+archiver = PayloadArchiver(
+    after_days=config.ARCHIVE_AFTER_DAYS,
+    interval=config.ARCHIVE_INTERVAL,
+    batch_size=config.ARCHIVE_BATCH_SIZE,
+)
+
+
+def _split_item(item: dict) -> tuple:
+    """Payment kwargs of a queue item, and its (received_at, group_id, message_id) bookkeeping."""
+    kwargs = dict(item)
+    kwargs.pop("released", None)
+    return kwargs, (kwargs.pop("received_at", None), kwargs.pop("group_id"), kwargs.pop("message_id"))
+
+
+def _release(item: dict) -> None:
+    """Drop the checkpoint hold and park count submit_payment took for ``item``; only once."""
+    if item.get("released"):
+        return
+    item["released"] = True
+    checkpoints.done(item["group_id"], item["message_id"])
+    item["park"].in_flight -= 1
+
+
+async def _process(item: dict) -> None:
+    kwargs, (received_at, group_id, message_id) = _split_item(item)
+    park = kwargs["park"]
+    try:
+        ok, payment, msg = await save_payment_and_topup(**kwargs)
+    except asyncio.CancelledError:
+        # Stopped mid-item: the queue hands it to overflow, which releases it once persisted
+        raise
+    except BaseException:
+        _release(item)
+        raise
+    _release(item)
+    metrics.PAYMENT_SECONDS.observe(time.perf_counter() - received_at, park=park.name)
+    print(f"✅ Processed txn {kwargs['provider_txn_id']} for park {park.name}: ok={ok}, msg={msg}")
+
+
+async def _persist_for_recovery(item: dict) -> None:
+    kwargs, _ = _split_item(item)
+    try:
+        ok, payment, msg = await save_payment_for_recovery(**kwargs)
+    finally:
+        _release(item)
+    print(f"⏸ Saved txn {kwargs['provider_txn_id']} for recovery: ok={ok}, msg={msg}")
+
+
+# Bounded intake: a burst never fans out into more than PAYMENT_WORKERS concurrent payments;
+# past the high watermark payments are saved as 'created' and recovery picks them up as
+# soon as the queue has drained to the low watermark
+payment_queue = WorkQueue(
+    _process,
+    _persist_for_recovery,
+    workers=config.PAYMENT_WORKERS,
+    high_watermark=config.PAYMENT_QUEUE_HIGH,
+    low_watermark=config.PAYMENT_QUEUE_LOW,
+    on_drained=lambda: recovery.wake(min_age=0),
+)
+
+
+
+def _health() -> tuple[bool, dict]:
+    """Worker health for /healthz: connected to Telegram and taking payments."""
+    connected = bool(app.is_connected)
+    return connected and payment_queue.accepting, {
+        "worker": config.WORKER_INDEX,
+        "parks": [park.name for park in config.PARKS.values()],
+        "telegram_connected": connected,
+        "payment_queue": len(payment_queue),
+        "shedding": payment_queue.shedding,
+        "open_circuits": sorted(park.name for park in config.PARKS.values()
+                                if park.api.breaker.recorded_state != park.api.breaker.CLOSED),
+    }
+
+
+metrics_server = metrics.MetricsServer(
+    host=config.METRICS_HOST,
+    port=config.METRICS_PORT + config.WORKER_INDEX if config.METRICS_PORT else 0,
+    health=_health,
+)
+metrics.IN_FLIGHT.set_function(lambda: len(in_flight_payments))
+metrics.CREATED_BACKLOG.set_function(lambda: recovery.backlog)
+metrics.PAYMENT_QUEUE.set_function(lambda: len(payment_queue))
+metrics.TOPUP_QUEUE.set_function(lambda: len(topup_scheduler))
+metrics.NOTIFY_QUEUE.set_function(lambda: dispatcher.queued)
+
 # Pyrogram configuration
 api_id = config.APP_ID
 api_hash = config.APP_SECRET
 app_title = config.APP_TITLE
-# Use workdir parameter to explicitly set session file location
-app = Client(app_title, api_id=api_id, api_hash=api_hash, workdir=".")
+# Use workdir parameter to explicitly set session file location.
+# Each supervisor worker is its own Telegram session (authorize it once by running this
+# file with its WORKER_INDEX / WORKER_COUNT set)
+session_name = app_title if config.WORKER_COUNT == 1 else f"{app_title}_worker{config.WORKER_INDEX}"
+app = Client(session_name, api_id=api_id, api_hash=api_hash, workdir=".")
 
 
 def safe_text(msg):
@@ -26,14 +158,21 @@ def safe_text(msg):
 
 def get_park_by_group_id(group_id: int):
     """Telegram group_id orqali tegishli parkni topadi"""
-    for park in PARKS.values():
-        if str(group_id) in park.telegram_groups:
-            return park
-    return None
+    return config.GROUP_ROUTES.get(str(group_id))
 
 
-@app.on_message(filters.group)
+def _chat_filter_ids(group_ids) -> list:
+    # filters.chat matches numeric ids as int and @usernames as str
+    return [int(g) if g.lstrip("-").isdigit() else g for g in group_ids]
+
+
+# Only messages from configured park groups reach handle_message; reload_parks() updates the set in place
+park_groups = filters.chat(_chat_filter_ids(config.GROUP_ROUTES))
+
+
+@app.on_message(filters.group & park_groups)
 async def handle_message(client, message):
+    received_at = time.perf_counter()
     try:
         text = safe_text(message.text or message.caption or "")
         chat = message.chat
@@ -44,14 +183,19 @@ async def handle_message(client, message):
         if not park:
             print(f"❌ Unknown park for group {group_id}")
             return
+        checkpoints.seen(group_id, message.id)
+
+        metrics.MESSAGES.inc(park=park.name, provider=park.provider, stage="seen")
 
         # Ma'lumotlarni parse qilish
-        provider_txn_id = parse_provider_txn_id(text)
-        callsign = parse_callsign(text)
-        amount = parse_amount(text)
+        parsed = parse_message(text)
+        provider_txn_id = parsed.provider_txn_id
+        callsign = parsed.callsign
+        amount = parsed.amount
 
         category_id =_get_category_id(park.provider, park)
-        if not is_successful_payment(text):
+        if not parsed.success:
+            metrics.MESSAGES.inc(park=park.name, provider=park.provider, stage="ignored")
             print(f"⚠️ NOT successful → ignored. Txn={provider_txn_id}")
             notify_payment_error(
                 park,
@@ -64,33 +208,138 @@ async def handle_message(client, message):
                 context="is_successful_payment returned False",
             )
             return
+        metrics.MESSAGES.inc(park=park.name, provider=park.provider, stage="parsed")
 
+        await submit_payment(park, message, parsed, received_at)
 
+    except Exception as e:
+        print("🔥 Error in handle_message:", e)
 
-        raw_payload = {
-            "raw_text": text,
-            "group_id": group_id,
-            "group_title": getattr(chat, "title", None),
-        }
 
-        # Asosiy ishlovchi task
-        async def _process():
-            ok, payment, msg = save_payment_and_topup(
-                provider=park.provider,
-                provider_txn_id=provider_txn_id,
-                callsign=callsign,
-                amount_uzs=amount,
-                raw_payload=raw_payload,
-                park=park,
-            )
-            print(f"✅ Processed txn {provider_txn_id} for park {park.name}: ok={ok}, msg={msg}")
+async def submit_payment(park, message, parsed, received_at: float | None = None) -> None:
+    """Hand a successful payment message to the worker pool (live and catch-up alike)."""
+    chat = message.chat
+    group_id = str(chat.id)
+    if already_performed(park, park.provider, parsed.provider_txn_id):
+        print(f"♻️ Duplicate txn {parsed.provider_txn_id} for park {park.name} ignored")
+        return
+    raw_payload = {
+        "raw_text": safe_text(message.text or message.caption or ""),
+        "group_id": group_id,
+        "group_title": getattr(chat, "title", None),
+    }
+    checkpoints.begin(group_id, message.id)
+    # Released once by _release, from _process or _persist_for_recovery
+    park.in_flight += 1
+
+    # Asosiy ishlovchi navbat
+    await payment_queue.submit({
+        "provider": park.provider,
+        "provider_txn_id": parsed.provider_txn_id,
+        "callsign": parsed.callsign,
+        "amount_uzs": parsed.amount,
+        "raw_payload": raw_payload,
+        "park": park,
+        "received_at": time.perf_counter() if received_at is None else received_at,
+        "group_id": group_id,
+        "message_id": message.id,
+    })
+
 
-        asyncio.create_task(_process())
+async def _catch_up() -> None:
+    routes = config.GROUP_ROUTES
+    chat_ids = {group_id: _chat_filter_ids([group_id])[0] for group_id in routes}
+    total = await catch_up(app, routes, chat_ids, checkpoints, submit_payment,
+                           limit=config.CATCHUP_LIMIT, rate=config.CATCHUP_RATE)
+    print(f"⏪ Catch-up finished: {total} missed payments queued")
 
+
+async def reload_parks() -> None:
+    """Switch to the parks now in config.PARKS_FILE without a restart; a bad file changes nothing."""
+    try:
+        await config.reload_parks()
     except Exception as e:
-        print("🔥 Error in handle_message:", e)
+        print("🔥 Park reload failed, keeping the current parks:", e)
+        return
+    _watch_breakers(config.PARKS)
+    recovery.update_parks(config.PARKS)
+    groups = filters.chat(_chat_filter_ids(config.GROUP_ROUTES))
+    park_groups.intersection_update(groups)
+    park_groups.update(groups)
+    print(f"🔄 Parks reloaded: {', '.join(park.name for park in config.PARKS.values())}")
+
+
+def _mtime(path: str) -> int | None:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+async def _watch_parks(requested: asyncio.Event) -> None:
+    """Reload the parks when ``requested`` is set (SIGHUP) or PARKS_FILE has changed.
+
+    A changed file is only read once its mtime has held for a whole check interval, so a
+    file still being written is not loaded half-way.
+    """
+    interval = config.PARKS_RELOAD_INTERVAL if config.PARKS_RELOAD_INTERVAL > 0 else None
+    loaded = changed = _mtime(config.PARKS_FILE)
+    while True:
+        try:
+            await asyncio.wait_for(requested.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+        mtime = _mtime(config.PARKS_FILE)
+        if requested.is_set() or (mtime != loaded and mtime == changed):
+            requested.clear()
+            loaded = mtime
+            await reload_parks()
+        changed = mtime
+
+
+async def main():
+    catchup_task = None
+    watch_task = None
+    try:
+        dispatcher.start()
+        status_writer.start()
+        await config.start_parks(config.PARKS)
+        print(f"♻️ {await warm_performed_txns()} performed txn ids cached")
+        payment_queue.start()
+        recovery.start()
+        # One archiver is enough for the shared database
+        if config.ARCHIVE_AFTER_DAYS > 0 and config.WORKER_INDEX == 0:
+            archiver.start()
+        await metrics_server.start()
+        await checkpoints.load()
+        if config.CATCHUP_ENABLED:
+            # Before live intake starts: no group may move past what its catch-up replays
+            checkpoints.hold_start(config.GROUP_ROUTES)
+        checkpoints.start()
+        reload_requested = asyncio.Event()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, reload_requested.set)
+        watch_task = asyncio.create_task(_watch_parks(reload_requested))
+        async with app:
+            if config.CATCHUP_ENABLED:
+                catchup_task = asyncio.create_task(_catch_up())
+            await idle()
+    finally:
+        for task in (catchup_task, watch_task):
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        await metrics_server.stop()
+        await payment_queue.stop(config.PAYMENT_DRAIN_TIMEOUT)
+        await checkpoints.stop()
+        await recovery.stop()
+        await archiver.stop()
+        await topup_scheduler.stop()
+        await config.close_parks(config.PARKS)
+        await dispatcher.stop()
+        await status_writer.stop()
+        await close_db()
 
 
 if __name__ == "__main__":
     print("🚀 Bot starting...")
-    app.run()
+    app.run(main())
@@ -1,30 +1,154 @@
-import requests
+import asyncio
+import httpx
+from collections import deque
 from html import escape
 from decimal import Decimal, ROUND_HALF_UP
 from telegram.constants import ParseMode
 import config
+from metrics import TELEGRAM_SEND_SECONDS, timed
 
 
-def _post(url: str, payload: dict) -> None:
-    try:
-        resp = requests.post(url, json=payload, timeout=10)
-        resp.raise_for_status()
-    except Exception as e:
-        print("Telegram error:", e, payload)
+class NotificationDispatcher:
+    """Background sender for Telegram notifications.
 
+    ``submit()`` never blocks: messages go into a bounded queue and are dropped (with a
+    log line) when it is full. One pooled HTTP client sends them while respecting
+    Telegram's limits: at most one message per ``chat_interval`` seconds to the same chat,
+    ``global_rate`` messages per second overall, and ``retry_after`` on a 429. With
+    ``digest`` on, messages that pile up for a chat while it waits for its next slot are
+    merged into a single message.
+    """
 
-def send_html(bot_token: str, chat_id: str, html: str) -> None:
-    if not bot_token or not chat_id:
-        return
-    _post(
-        f"https://api.telegram.org/bot{bot_token}/sendMessage",
-        {
+    MAX_TEXT = 4096
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, *, maxsize: int = 1000, chat_interval: float = 3.0, global_rate: float = 30.0,
+                 digest: bool = False, api_base: str = "https://api.telegram.org"):
+        self.chat_interval = chat_interval
+        self.global_interval = 1.0 / global_rate if global_rate > 0 else 0.0
+        self.digest = digest
+        self.api_base = api_base.rstrip("/")
+
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self._pending: dict[tuple, deque] = {}
+        self._senders: dict[tuple, asyncio.Task] = {}
+        self._chat_ready_at: dict[tuple, float] = {}
+        self._global_ready_at = 0.0
+        self._global_lock = asyncio.Lock()
+        self._client = httpx.AsyncClient(timeout=10, limits=httpx.Limits(max_connections=10))
+        self._task: asyncio.Task | None = None
+
+    @property
+    def queued(self) -> int:
+        return self._queue.qsize() + sum(len(pending) for pending in self._pending.values())
+
+    def submit(self, bot_token: str, chat_id: str, html: str) -> bool:
+        try:
+            self._queue.put_nowait((bot_token, str(chat_id), html))
+            return True
+        except asyncio.QueueFull:
+            print("Telegram queue full, notification dropped:", chat_id)
+            return False
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """Send what is already queued (up to ``timeout`` seconds), then shut down."""
+        try:
+            await asyncio.wait_for(self._drain(), timeout)
+        except asyncio.TimeoutError:
+            print("Telegram queue not drained, dropping", self._queue.qsize(), "notifications")
+        for task in [self._task, *self._senders.values()]:
+            if task is not None:
+                task.cancel()
+        await asyncio.gather(*(t for t in [self._task, *self._senders.values()] if t), return_exceptions=True)
+        self._task = None
+        self._senders.clear()
+        await self._client.aclose()
+
+    async def _drain(self) -> None:
+        while self._queue.qsize() or self._senders:
+            await asyncio.sleep(0.05)
+
+    async def _run(self) -> None:
+        while True:
+            bot_token, chat_id, html = await self._queue.get()
+            key = (bot_token, chat_id)
+            self._pending.setdefault(key, deque()).append(html)
+            if key not in self._senders:
+                self._senders[key] = asyncio.create_task(self._send_chat(key))
+
+    def _next_text(self, pending: deque) -> str:
+        text = pending.popleft()
+        if not self.digest:
+            return text
+        while pending and len(text) + 2 + len(pending[0]) <= self.MAX_TEXT:
+            text += "\n\n" + pending.popleft()
+        return text
+
+    async def _wait_slot(self, key: tuple) -> None:
+        loop = asyncio.get_running_loop()
+        delay = self._chat_ready_at.get(key, 0.0) - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        async with self._global_lock:
+            delay = self._global_ready_at - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._global_ready_at = loop.time() + self.global_interval
+
+    async def _send_chat(self, key: tuple) -> None:
+        pending = self._pending[key]
+        try:
+            while pending:
+                await self._wait_slot(key)
+                await self._send(key, self._next_text(pending))
+                self._chat_ready_at[key] = asyncio.get_running_loop().time() + self.chat_interval
+        finally:
+            del self._senders[key]
+            if not pending:
+                self._pending.pop(key, None)
+
+    @timed(TELEGRAM_SEND_SECONDS)
+    async def _send(self, key: tuple, html: str) -> None:
+        bot_token, chat_id = key
+        payload = {
             "chat_id": chat_id,
             "text": html,
             "parse_mode": ParseMode.HTML,
             "disable_web_page_preview": True,
-        },
-    )
+        }
+        for _ in range(self.MAX_ATTEMPTS):
+            try:
+                resp = await self._client.post(f"{self.api_base}/bot{bot_token}/sendMessage", json=payload)
+                if resp.status_code == 429:
+                    retry_after = (resp.json().get("parameters") or {}).get("retry_after", 1)
+                    self._chat_ready_at[key] = asyncio.get_running_loop().time() + retry_after
+                    await self._wait_slot(key)
+                    continue
+                resp.raise_for_status()
+                return
+            except Exception as e:
+                print("Telegram error:", e, payload)
+                return
+        print("Telegram rate limit, notification dropped:", payload)
+
+
+dispatcher = NotificationDispatcher(
+    maxsize=config.NOTIFY_QUEUE_SIZE,
+    chat_interval=config.NOTIFY_CHAT_INTERVAL,
+    global_rate=config.NOTIFY_GLOBAL_RATE,
+    digest=config.NOTIFY_DIGEST,
+    api_base=config.TELEGRAM_API_BASE,
+)
+
+
+def send_html(bot_token: str, chat_id: str, html: str) -> None:
+    if not bot_token or not chat_id:
+        return
+    dispatcher.submit(bot_token, chat_id, html)
 
 
 def _kv(key: str, val) -> str:
@@ -89,3 +213,23 @@ def notify_payment_error(park, *, title: str, error_msg: str, provider: str | No
     if context:
         rows.append(_kv("Context", context))
     send_html(bot, chat, "\n".join(rows))
+
+
+def notify_circuit_state(park, breaker, old_state: str, new_state: str):
+    """Tell the park's chat when Yandex calls for it are suspended or resumed."""
+    if not getattr(config, "TELEGRAM_ENABLED", True):
+        return
+    bot = config.BOT_TOKEN
+    chat = getattr(park, "notification_chat_id", "") or getattr(config, "TELEGRAM_CHAT_ID", "")
+    if not bot or not chat:
+        return
+    if new_state == "open":
+        title = f"⛔️ <b>Yandex API to'xtatildi ( #{park.name})</b>"
+        note = "To'lovlar navbatda saqlanadi va API tiklangach o'tkaziladi"
+    elif new_state == "closed":
+        title = f"✅ <b>Yandex API tiklandi ( #{park.name})</b>"
+        note = "Navbatdagi to'lovlar o'tkazilmoqda"
+    else:
+        return
+    rows = [title, _kv("Holat", f"{old_state} → {new_state}"), _kv("Izoh", note)]
+    send_html(bot, chat, "\n".join(rows))
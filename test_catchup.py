@@ -0,0 +1,65 @@
+"""Live messages must not move a group's checkpoint past payments its catch-up hasn't replayed.
+
+Groups are caught up one after another while live intake and the flush loop already run.
+A live message in g2, seen and flushed while g1 is still being caught up, used to make
+g2's catch-up start from that message and skip everything missed before it.
+"""
+import asyncio
+from types import SimpleNamespace
+
+import catchup
+import database
+
+
+def _message(group_id, message_id, payment):
+    text = f"✅ Успешно оплачен\n🧾 {message_id}\n🇺🇿 1 000 сум\n🔸 Позывной: A1" if payment else "salom"
+    return SimpleNamespace(id=message_id, text=text, caption=None, chat=SimpleNamespace(id=group_id))
+
+
+class FakeClient:
+    def __init__(self, history, delay=0.0):
+        self.history = history
+        self.delay = delay
+
+    async def get_chat_history(self, chat_id, limit):
+        for message in reversed(self.history[chat_id]):
+            await asyncio.sleep(self.delay)
+            yield message
+
+
+def test_live_message_does_not_skip_missed_payments(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_NAME", str(tmp_path / "payments.db"))
+    database.init_db()
+    database.save_checkpoints({"g1": 10, "g2": 20})
+
+    history = {
+        "g1": [_message("g1", i, payment=False) for i in range(11, 21)],
+        "g2": [_message("g2", i, payment=True) for i in range(21, 31)],
+    }
+    client = FakeClient(history, delay=0.01)
+    park = SimpleNamespace(provider="click", name="P_click")
+    submitted = []
+
+    async def submit(park, message, parsed):
+        submitted.append((message.chat.id, message.id))
+
+    async def scenario():
+        checkpoints = catchup.GroupCheckpoints(flush_interval=3600)
+        await checkpoints.load()
+        checkpoints.hold_start(["g1", "g2"])
+
+        task = asyncio.create_task(catchup.catch_up(client, {"g1": park, "g2": park}, {"g1": "g1", "g2": "g2"},
+                                                    checkpoints, submit, rate=0))
+        await asyncio.sleep(0.03)
+        # Live message in g2 while g1 is still being caught up, and a flush right after it
+        checkpoints.seen("g2", 31)
+        await checkpoints.flush()
+        assert database.load_checkpoints()["g2"] == 20
+
+        assert await task == 10
+        await checkpoints.flush()
+        return database.load_checkpoints()
+
+    stored = asyncio.run(scenario())
+    assert submitted == [("g2", i) for i in range(21, 31)]
+    assert stored == {"g1": 20, "g2": 31}
@@ -0,0 +1,84 @@
+"""A combined top-up's idempotency token is never sent to Yandex with two different amounts.
+
+Three payments for one driver are topped up as one combined call that Yandex refuses, so
+all of them fail holding the batch token. When one of them is redelivered, the live path
+and the recovery worker must both resend that token for the same total, never for the
+redelivered payment alone.
+"""
+import asyncio
+import os
+from collections import defaultdict
+from decimal import Decimal
+
+os.environ.setdefault("TOPUP_BATCH_WINDOW", "0.05")
+os.environ.setdefault("PROVIDER_CLICK", "click-category")
+
+import database
+import recovery
+import utils
+
+
+class FakeAPI:
+    park_id = "park"
+
+    def __init__(self):
+        self.sent = defaultdict(set)
+        self.fail = True
+
+    async def topup_balance(self, driver_id, category_id, amount, idempotency_token=None):
+        self.sent[idempotency_token].add(amount)
+        return not self.fail
+
+
+class FakeDrivers:
+    async def resolve(self, callsign):
+        return {"driver_profile": {"id": f"driver-{callsign}"}, "car": {"callsign": callsign}}
+
+
+class FakePark:
+    name = "P_click"
+    park_id = "park"
+    provider = "click"
+    payment_fee = 0
+    notification_chat_id = ""
+    in_flight = 0
+
+    def __init__(self):
+        self.api = FakeAPI()
+        self.drivers = FakeDrivers()
+
+
+def _pay(park, txn, amount):
+    return utils.save_payment_and_topup("click", txn, "A1", Decimal(amount), {}, park)
+
+
+def _statuses():
+    return dict(database.get_conn().execute("SELECT provider_txn_id, status FROM payments"))
+
+
+def test_batch_token_only_resent_with_whole_group(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_NAME", str(tmp_path / "payments.db"))
+    monkeypatch.setattr(utils.config, "TELEGRAM_ENABLED", False, raising=False)
+    database.init_db()
+    park = FakePark()
+    utils.performed_txns._items.clear()
+
+    async def scenario():
+        # One combined call for 600, refused
+        await asyncio.gather(_pay(park, "t1", 100), _pay(park, "t2", 200), _pay(park, "t3", 300))
+        assert len(park.api.sent) == 1
+        assert set(_statuses().values()) == {"failed"}
+
+        # t1 redelivered, Yandex still refusing: the whole group goes out again
+        await _pay(park, "t1", 100)
+        # t2 redelivered and left for recovery
+        database.get_conn().execute("UPDATE payments SET status = 'created' WHERE provider_txn_id = 't2'")
+        worker = recovery.PaymentRecovery({"P": park}, min_age=0)
+        park.api.fail = False
+        assert await worker.run_once(0) == 1
+        assert set(_statuses().values()) == {"performed"}
+
+    asyncio.run(scenario())
+
+    for token, amounts in park.api.sent.items():
+        assert len(amounts) == 1, f"token {token} sent with {sorted(amounts)}"
@@ -1,10 +1,18 @@
+import asyncio
+import json
+import uuid
+from collections import OrderedDict
 from decimal import Decimal, ROUND_HALF_UP, InvalidOperation
 from datetime import datetime
 from typing import Tuple
 
 import config
-from yandex import YandexTaxiAPI
-from database import save_payment, update_payment_status
+from drivers import callsign_key, driver_profile_id
+from metrics import PAYMENTS
+from scheduler import KeyedScheduler
+from yandex import StaleDriverError, CircuitOpenError
+from database import (run_db, save_payment_async, update_payment_status_async, assign_idempotency_token,
+                      recent_performed_txn_ids, reopen_token_groups, to_tiyin)
 from telegram_notification import notify_payment_success, notify_payment_error
 
 
@@ -31,12 +39,54 @@ def _apply_provider_fee(provider: str, amount: Decimal, park) -> Decimal:
     return (amount * multiplier).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
 
 
-def save_payment_and_topup(provider: str, provider_txn_id: str, callsign: str,
-                           amount_uzs: Decimal, raw_payload: dict, park) -> Tuple[bool, dict, str]:
+class RecentTxnSet:
+    """Bounded LRU set of ``(provider, provider_txn_id)`` pairs already performed.
 
-    category_id = _get_category_id(provider, park)
+    Only a fast path for redeliveries: a miss says nothing, and the UNIQUE constraint on
+    ``payments`` stays the source of truth. Exact membership, unlike a Bloom filter,
+    so a real payment is never dropped on a false positive.
+    """
+
+    def __init__(self, maxsize: int = 100_000):
+        self.maxsize = maxsize
+        self._items: OrderedDict = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __contains__(self, key: tuple) -> bool:
+        if key in self._items:
+            self._items.move_to_end(key)
+            return True
+        return False
+
+    def add(self, key: tuple) -> None:
+        self._items[key] = None
+        self._items.move_to_end(key)
+        if len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+
+performed_txns = RecentTxnSet(config.PERFORMED_CACHE_SIZE)
+
+
+async def warm_performed_txns() -> int:
+    for provider, provider_txn_id in await run_db(recent_performed_txn_ids, performed_txns.maxsize):
+        performed_txns.add((provider, provider_txn_id))
+    return len(performed_txns)
 
-    ok, payment, msg = save_payment(
+
+def already_performed(park, provider: str, provider_txn_id: str) -> bool:
+    """True (and counted) when the payment is known to be performed, before any DB or Yandex work."""
+    if (provider, provider_txn_id) in performed_txns:
+        _count(park, provider, "skipped", "duplicate")
+        return True
+    return False
+
+
+async def _save_created(provider: str, provider_txn_id: str, callsign: str,
+                        amount_uzs: Decimal, raw_payload: dict, park, category_id: str) -> Tuple[bool, dict, str]:
+    ok, payment, msg = await save_payment_async(
         provider=provider,
         provider_txn_id=provider_txn_id,
         callsign=callsign,
@@ -45,85 +95,303 @@ def save_payment_and_topup(provider: str, provider_txn_id: str, callsign: str,
         raw_payload=raw_payload,
         status="created",
         park_group_id=park.name,
+        idempotency_token=idempotency_token(provider, provider_txn_id),
     )
+    if not ok:
+        _count(park, provider, "skipped", "duplicate" if payment else "db_error")
+        if payment.get("status") == "performed":
+            performed_txns.add((provider, provider_txn_id))
+    return ok, payment, msg
+
+
+async def save_payment_for_recovery(provider: str, provider_txn_id: str, callsign: str,
+                                    amount_uzs: Decimal, raw_payload: dict, park) -> Tuple[bool, dict, str]:
+    """Only persist the payment as 'created'; the recovery worker does the top-up later."""
+    ok, payment, msg = await _save_created(provider, provider_txn_id, callsign, amount_uzs, raw_payload,
+                                           park, _get_category_id(provider, park))
+    if ok:
+        _count(park, provider, "deferred", "overflow")
+    return ok, payment, msg
+
+
+async def save_payment_and_topup(provider: str, provider_txn_id: str, callsign: str,
+                           amount_uzs: Decimal, raw_payload: dict, park) -> Tuple[bool, dict, str]:
+
+    if already_performed(park, provider, provider_txn_id):
+        return False, {"status": "performed"}, "already performed"
+
+    category_id = _get_category_id(provider, park)
+
+    ok, payment, msg = await _save_created(provider, provider_txn_id, callsign, amount_uzs, raw_payload,
+                                           park, category_id)
     if not ok:
         return False, payment, msg
 
-    payment_id = int(payment["id"])
+    ok, msg = await topup_payment(int(payment["id"]), provider, provider_txn_id, callsign,
+                                  amount_uzs, raw_payload, park, category_id, payment["idempotency_token"])
+    return ok, payment, msg
+
+
+# Yandex is not being called for this park right now; the payment stays 'created'
+# and the recovery worker tops it up once the park's circuit closes again.
+CIRCUIT_OPEN_MSG = "yandex circuit open, left for recovery"
+
+# The driver lookup failed (timeout, 5xx, retry budget spent); the payment stays 'created' too
+LOOKUP_FAILED_MSG = "driver lookup failed, left for recovery"
+
+IN_PROGRESS_MSG = "top-up already queued in this process"
+
+# Payments queued or running in this process; the recovery worker leaves them alone
+in_flight_payments: set[int] = set()
+
+
+def idempotency_token(provider: str, provider_txn_id: str) -> str:
+    """Same token for every top-up attempt of one provider payment, across retries and restarts."""
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"yandex-topup:{provider}:{provider_txn_id}"))
+
+
+def _count(park, provider: str, result: str, reason: str, n: int = 1) -> None:
+    PAYMENTS.inc(n, park=park.name, provider=provider, result=result, reason=reason)
+
+
+def batch_token(tokens) -> str:
+    """Idempotency token of one combined top-up, derived from its payments' own tokens."""
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, "yandex-topup-batch:" + ",".join(sorted(tokens))))
+
+
+class TopupJob:
+    """One saved payment waiting for its Yandex top-up."""
+
+    __slots__ = ("payment_id", "provider", "provider_txn_id", "callsign", "amount_uzs",
+                 "raw_payload", "park", "category_id", "token")
+
+    def __init__(self, payment_id: int, provider: str, provider_txn_id: str, callsign: str,
+                 amount_uzs: Decimal, raw_payload: dict, park, category_id: str, token: str | None = None):
+        self.payment_id = payment_id
+        self.provider = provider
+        self.provider_txn_id = provider_txn_id
+        self.callsign = callsign
+        self.amount_uzs = amount_uzs
+        self.raw_payload = raw_payload
+        self.park = park
+        self.category_id = category_id
+        # rows saved before tokens were stored get the same derived value
+        self.token = token or idempotency_token(provider, provider_txn_id)
+
+    @classmethod
+    def from_row(cls, row: dict, park) -> "TopupJob":
+        raw_payload = json.loads(row["raw_payload"]) if row["raw_payload"] else {}
+        return cls(row["id"], row["provider"], row["provider_txn_id"], row["callsign"], Decimal(row["amount"]),
+                   raw_payload, park, row["category_id"], row["idempotency_token"])
+
+    @property
+    def batched(self) -> bool:
+        """True once the payment's token was replaced by a combined top-up's token."""
+        return self.token != idempotency_token(self.provider, self.provider_txn_id)
+
+
+def _can_merge(first: list, other: list) -> bool:
+    # Only fresh single payments are combined; a group recovered from an earlier combined
+    # top-up must be replayed exactly as it was, under its stored token.
+    if len(first) != 1 or len(other) != 1:
+        return False
+    a, b = first[0], other[0]
+    limit = config.TOPUP_BATCH_MAX_AMOUNT
+    if limit and (a.amount_uzs > limit or b.amount_uzs > limit):
+        return False
+    return (a.park is b.park and a.provider == b.provider and a.category_id == b.category_id
+            and not a.batched and not b.batched)
+
+
+async def _run_topups(units: list) -> Tuple[bool, str]:
+    jobs = [job for unit in units for job in unit]
+    token = jobs[0].token
+    if len(units) > 1:
+        # Persist the combined token first: if we die mid-call, recovery replays the same batch
+        token = batch_token(job.token for job in jobs)
+        await run_db(assign_idempotency_token, [job.payment_id for job in jobs], token)
+    return await _topup_jobs(jobs[0].park, jobs, token)
+
+
+topup_scheduler = KeyedScheduler(
+    _run_topups,
+    batch_window=config.TOPUP_BATCH_WINDOW,
+    max_batch=config.TOPUP_MAX_BATCH,
+    can_merge=_can_merge,
+)
+
+
+async def schedule_topup(jobs: list) -> Tuple[bool, str]:
+    """Queue ``jobs`` (one payment, or a recovered combined group) behind the driver's earlier top-ups.
+
+    Top-ups for one driver run one after another; different drivers run in parallel. The
+    driver profile id is only known after resolving, so work is keyed by park and callsign.
+    """
+    head = jobs[0]
+    key = (head.park.park_id, callsign_key(head.callsign))
+    ids = [job.payment_id for job in jobs]
+    if not in_flight_payments.isdisjoint(ids):
+        # The same provider message delivered twice while the first copy is still queued
+        _count(head.park, head.provider, "skipped", "in_progress", len(jobs))
+        return False, IN_PROGRESS_MSG
+    in_flight_payments.update(ids)
+    try:
+        return await asyncio.shield(topup_scheduler.submit(key, jobs))
+    finally:
+        in_flight_payments.difference_update(ids)
+
+
+async def topup_payment(payment_id: int, provider: str, provider_txn_id: str, callsign: str,
+                        amount_uzs: Decimal, raw_payload: dict, park, category_id: str,
+                        token: str | None = None) -> Tuple[bool, str]:
+    """Steps after the payment row exists: resolve the driver, top up, record the outcome, notify.
+
+    ``token`` is the idempotency token stored on the payment row. A payment still holding
+    the token of an earlier combined top-up (redelivered after that top-up failed) is only
+    replayed together with the rest of that group, for the same total.
+    """
+    job = TopupJob(payment_id, provider, provider_txn_id, callsign, amount_uzs, raw_payload, park,
+                   category_id, token)
+    if not job.batched:
+        return await schedule_topup([job])
+    rows = await run_db(reopen_token_groups, [job.token])
+    if not rows:
+        return False, "combined top-up already performed"
+    return await schedule_topup([TopupJob.from_row(row, park) for row in rows])
+
+
+async def _set_status(jobs: list, status: str, topup_amounts: list = None, **fields) -> None:
+    # Waits for the commit: the payments leave in_flight_payments right after, and from then
+    # on the recovery worker must see the final status, not 'created'
+    topups = [to_tiyin(amount) for amount in topup_amounts] if topup_amounts else [None] * len(jobs)
+    await asyncio.gather(*(update_payment_status_async(job.payment_id, status, topup_tiyin=topup, wait=True,
+                                                       **fields)
+                           for job, topup in zip(jobs, topups)))
+
+
+def _lookup_deferred(park, jobs: list, error: Exception) -> Tuple[bool, str]:
+    # Yandex didn't answer the lookup: no money moved and nothing is known about the
+    # callsign, so the payments stay 'created' for recovery like with an open circuit
+    head = jobs[0]
+    print(f"⏸ Driver lookup for {head.callsign} in park {park.name} failed, left for recovery: {error}")
+    _count(park, head.provider, "deferred", "driver_lookup_failed", len(jobs))
+    return False, LOOKUP_FAILED_MSG
+
+
+async def _topup_jobs(park, jobs: list, token: str) -> Tuple[bool, str]:
+    """Top up the driver once for all ``jobs`` (same park and callsign); each row gets its own outcome."""
+    head = jobs[0]
+    callsign = head.callsign
 
     # 2. Resolve driver by callsign within this park
-    api = YandexTaxiAPI(park.park_id, park.clid, park.api_key)
-    driver = api.get_driver_by_callsign(callsign)
-    driver_id = None
-    if driver:
-        driver_profile = driver.get("driver_profile") or {}
-        driver_id = driver_profile.get("id") or driver.get("id")
+    api = park.api
+    try:
+        driver = await park.drivers.resolve(callsign)
+    except CircuitOpenError:
+        _count(park, head.provider, "deferred", "circuit_open", len(jobs))
+        return False, CIRCUIT_OPEN_MSG
+    except Exception as e:
+        return _lookup_deferred(park, jobs, e)
+    driver_id = driver_profile_id(driver) if driver else None
 
     if not driver_id:
-        update_payment_status(payment_id=payment_id, status="failed")
-        # notify park
-        try:
-            notify_payment_error(
-                park,
-                title=f"Haydovchi topilmadi #{park.name}",
-                error_msg=f"Haydovchi topilmadi",
-                provider=provider,
-                callsign=callsign,
-                amount_uzs=amount_uzs,
-                provider_txn_id=provider_txn_id,
-                context=f"park={park.park_id}",
-                payload_excerpt=str(raw_payload)[:500],
-            )
-        except Exception:
-            pass
-        return False, payment, "driver not found in park"
+        await _set_status(jobs, "failed")
+        for job in jobs:
+            # notify park
+            try:
+                notify_payment_error(
+                    park,
+                    title=f"Haydovchi topilmadi #{park.name}",
+                    error_msg=f"Haydovchi topilmadi",
+                    provider=job.provider,
+                    callsign=callsign,
+                    amount_uzs=job.amount_uzs,
+                    provider_txn_id=job.provider_txn_id,
+                    context=f"park={park.park_id}",
+                    payload_excerpt=str(job.raw_payload)[:500],
+                )
+            except Exception:
+                pass
+        _count(park, head.provider, "failed", "driver_not_found", len(jobs))
+        return False, "driver not found in park"
 
     # 3. Compute topup after provider fee
-    topup_amount = _apply_provider_fee(provider, amount_uzs, park)
+    amounts = [_apply_provider_fee(job.provider, job.amount_uzs, park) for job in jobs]
+    topup_amount = sum(amounts, Decimal("0"))
 
     ok_topup = False
     try:
-        ok_topup = api.topup_balance(driver_id=driver_id, category_id=provider, amount=float(topup_amount))
+        ok_topup = await api.topup_balance(driver_id=driver_id, category_id=head.provider,
+                                           amount=float(topup_amount), idempotency_token=token)
+    except CircuitOpenError:
+        _count(park, head.provider, "deferred", "circuit_open", len(jobs))
+        return False, CIRCUIT_OPEN_MSG
+    except StaleDriverError:
+        # Cached profile id no longer exists in the park: forget it and retry once with a live lookup
+        await park.drivers.mark_stale(callsign)
+        try:
+            driver = await park.drivers.resolve(callsign)
+        except CircuitOpenError:
+            _count(park, head.provider, "deferred", "circuit_open", len(jobs))
+            return False, CIRCUIT_OPEN_MSG
+        except Exception as e:
+            return _lookup_deferred(park, jobs, e)
+        fresh_id = driver_profile_id(driver) if driver else None
+        if fresh_id and fresh_id != driver_id:
+            driver_id = fresh_id
+            try:
+                ok_topup = await api.topup_balance(driver_id=driver_id, category_id=head.provider,
+                                                   amount=float(topup_amount), idempotency_token=token)
+            except CircuitOpenError:
+                _count(park, head.provider, "deferred", "circuit_open", len(jobs))
+                return False, CIRCUIT_OPEN_MSG
+            except Exception:
+                ok_topup = False
     except Exception:
         ok_topup = False
 
     if not ok_topup:
-        update_payment_status(payment_id=payment_id, status="failed")
-        try:
-            notify_payment_error(
-                park,
-                title="Yandex top-up xatosi",
-                error_msg="Yandex topup failed",
-                provider=provider,
-                callsign=callsign,
-                amount_uzs=amount_uzs,
-                provider_txn_id=provider_txn_id,
-                context=f"park={park.park_id}, driver_id={driver_id}, topup_amount={topup_amount}",
-                payload_excerpt=str(raw_payload)[:500],
-            )
-        except Exception:
-            pass
-        return False, payment, "yandex topup failed"
+        await _set_status(jobs, "failed")
+        for job, amount in zip(jobs, amounts):
+            try:
+                notify_payment_error(
+                    park,
+                    title="Yandex top-up xatosi",
+                    error_msg="Yandex topup failed",
+                    provider=job.provider,
+                    callsign=callsign,
+                    amount_uzs=job.amount_uzs,
+                    provider_txn_id=job.provider_txn_id,
+                    context=(f"park={park.park_id}, driver_id={driver_id}, topup_amount={amount}"
+                             + (f", batch={len(jobs)}/{topup_amount}" if len(jobs) > 1 else "")),
+                    payload_excerpt=str(job.raw_payload)[:500],
+                )
+            except Exception:
+                pass
+        _count(park, head.provider, "failed", "topup_failed", len(jobs))
+        return False, "yandex topup failed"
 
-    update_payment_status(payment_id=payment_id, status="performed", driver_profile_id=driver_id,
-                          performed_at=datetime.utcnow().isoformat())
-
-    if ok_topup:
+    await _set_status(jobs, "performed", amounts, driver_profile_id=driver_id,
+                      performed_at=datetime.utcnow().isoformat())
+    for job in jobs:
+        performed_txns.add((job.provider, job.provider_txn_id))
+    for job, amount in zip(jobs, amounts):
         try:
             notify_payment_success(
                 park,
-                provider=category_id,
+                provider=job.category_id,
                 callsign=callsign,
-                original_amount=amount_uzs,
-                topup_amount=topup_amount,
+                original_amount=job.amount_uzs,
+                topup_amount=amount,
                 driver_id=driver_id,
-                provider_txn_id=provider_txn_id,
+                provider_txn_id=job.provider_txn_id,
             )
-            print("sent notif ", category_id)
+            print("sent notif ", job.category_id)
         except Exception:
-            return
+            pass
 
-    return True, payment, "ok"
+    _count(park, head.provider, "performed", "ok", len(jobs))
+    return True, "ok"
 
 
 def _get_category_id(provider: str, park) -> str:
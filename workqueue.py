@@ -0,0 +1,90 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class WorkQueue:
+    """Bounded intake in front of a fixed pool of worker tasks.
+
+    ``submit()`` queues an item for ``handler`` while fewer than ``high_watermark`` items
+    wait. Past that the queue sheds: items go to ``overflow`` instead (which must persist
+    them for later) until the workers bring the backlog down to ``low_watermark``, when
+    ``on_drained`` is called so the shed work can be picked up again.
+
+    ``stop()`` stops intake, lets the workers finish the queue for up to ``timeout``
+    seconds, and hands whatever is still queued or unfinished to ``overflow``, so no item
+    is lost.
+    """
+
+    def __init__(self, handler, overflow, *, workers: int = 16, high_watermark: int = 500,
+                 low_watermark: int = 100, on_drained=None):
+        self.handler = handler
+        self.overflow = overflow
+        self.workers = workers
+        self.high_watermark = high_watermark
+        self.low_watermark = min(low_watermark, high_watermark)
+        self.on_drained = on_drained
+
+        self.shedding = False
+        self.accepting = False
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._tasks: list[asyncio.Task] = []
+
+    def __len__(self) -> int:
+        return self._queue.qsize()
+
+    async def submit(self, item) -> bool:
+        """Queue ``item``; returns False when it went to ``overflow`` instead."""
+        if self.accepting and not self.shedding:
+            if self._queue.qsize() < self.high_watermark:
+                self._queue.put_nowait(item)
+                return True
+            self.shedding = True
+            logger.warning("work queue above %d items, persisting new work for later", self.high_watermark)
+        await self._overflow(item)
+        return False
+
+    async def _overflow(self, item) -> None:
+        try:
+            await self.overflow(item)
+        except Exception as e:
+            logger.error("work queue overflow failed for %r: %s", item, e)
+
+    async def _work(self) -> None:
+        while True:
+            item = await self._queue.get()
+            try:
+                await self.handler(item)
+            except asyncio.CancelledError:
+                # Stopped mid-item: hand it over too; overflow has to tolerate work already saved
+                await self._overflow(item)
+                raise
+            except Exception as e:
+                logger.error("work queue item failed: %s", e)
+            finally:
+                self._queue.task_done()
+            if self.shedding and self._queue.qsize() <= self.low_watermark:
+                self.shedding = False
+                logger.warning("work queue down to %d items, accepting work again", self._queue.qsize())
+                if self.on_drained is not None:
+                    self.on_drained()
+
+    def start(self) -> None:
+        if not self._tasks:
+            self.accepting = True
+            self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        self.accepting = False
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("work queue not drained in %.1f s, %d items left", timeout, self._queue.qsize())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        while not self._queue.empty():
+            await self._overflow(self._queue.get_nowait())
+            self._queue.task_done()
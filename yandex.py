@@ -1,19 +1,223 @@
+import asyncio
 import uuid
-import requests
-from datetime import datetime
+import importlib.util
+import random
+import time
+import httpx
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 import logging
 
+from metrics import DRIVER_LOOKUP_SECONDS, TOPUP_SECONDS, YANDEX_REQUEST_SECONDS, timed
+
 logger = logging.getLogger(__name__)
 
+# HTTP/2 needs the optional "h2" package (httpx[http2]); fall back to HTTP/1.1 keep-alive without it.
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+
+class StaleDriverError(Exception):
+    """Yandex rejected a top-up because the driver profile id no longer exists in the park."""
+
+
+# Fleet API error codes ({"code": ..., "message": ...}) for a driver profile id the park
+# doesn't have; any other 400/404 (e.g. a validation error naming a driver field) is not one
+UNKNOWN_DRIVER_CODES = frozenset({"driver_profile_not_found", "driver_not_found"})
+
+
+def _is_unknown_driver(resp: httpx.Response) -> bool:
+    if resp.status_code not in (400, 404):
+        return False
+    try:
+        error = resp.json()
+    except ValueError:
+        return False
+    return isinstance(error, dict) and error.get("code") in UNKNOWN_DRIVER_CODES
+
+
+# Worth another attempt: timeouts, throttling and server-side failures. Any other 4xx
+# (bad request, auth, unknown driver, ...) will fail the same way again.
+RETRYABLE_STATUS = frozenset({408, 425, 429, 500, 502, 503, 504})
+
+
+def retry_after_seconds(resp: httpx.Response) -> float | None:
+    """Retry-After header as seconds; it may be a number or an HTTP date."""
+    value = resp.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max((when - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+class RetryBudget:
+    """Token bucket that caps how many retries one park may spend.
+
+    Each retry takes a token; tokens come back at ``refill_per_second``. When a park's
+    API is failing across the board, retries stop once the bucket is empty instead of
+    multiplying the load on it.
+    """
+
+    def __init__(self, capacity: float = 10.0, refill_per_second: float = 0.5):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def try_spend(self) -> bool:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.refill_per_second)
+        self._updated = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter, bounded by ``max_delay``, honouring Retry-After.
+
+    A Retry-After is waited out in full, never shortened; if the server asks for longer
+    than ``max_delay`` the policy gives up instead of retrying early.
+    """
+
+    def __init__(self, attempts: int = 3, base_delay: float = 0.5, max_delay: float = 10.0):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt: int, retry_after: float | None = None) -> float | None:
+        """Seconds to wait before the next attempt, or None to stop retrying."""
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if retry_after is not None:
+            if retry_after > self.max_delay:
+                return None
+            return max(retry_after, backoff)
+        return backoff
+
+
+class CircuitOpenError(Exception):
+    """A park's circuit breaker is open; the call was not sent to Yandex."""
+
+
+class CircuitBreaker:
+    """Per-park closed / open / half-open breaker around Fleet API calls.
+
+    ``failure_threshold`` consecutive failures (timeouts, transport errors, 429/5xx) open
+    it; while open every call fails fast with CircuitOpenError. After ``reset_timeout``
+    seconds one probe call is let through (half-open): success closes the breaker, failure
+    opens it again. ``on_change(breaker, old_state, new_state)`` is called on transitions.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0, on_change=None):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.on_change = on_change
+
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+
+    @property
+    def recorded_state(self) -> str:
+        """State as last recorded; unlike ``state`` it never moves open -> half-open, so
+        reading it (e.g. from a health check) can't fire ``on_change``."""
+        return self._state
+
+    @property
+    def state(self) -> str:
+        if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self._set_state(self.HALF_OPEN)
+        return self._state
+
+    def _set_state(self, state: str) -> None:
+        old, self._state = self._state, state
+        if state == self.OPEN:
+            self._opened_at = time.monotonic()
+        if state != self.HALF_OPEN:
+            self._probe_in_flight = False
+        if old != state:
+            logger.warning("Yandex circuit for %s: %s -> %s", self.name, old, state)
+            if self.on_change:
+                try:
+                    self.on_change(self, old, state)
+                except Exception as e:
+                    logger.error("circuit on_change callback failed: %s", e)
+
+    def before_call(self) -> None:
+        state = self.state
+        if state == self.OPEN or (state == self.HALF_OPEN and self._probe_in_flight):
+            raise CircuitOpenError(self.name)
+        if state == self.HALF_OPEN:
+            self._probe_in_flight = True
+
+    def release_probe(self) -> None:
+        self._probe_in_flight = False
+
+    def record_success(self) -> None:
+        self._failures = 0
+        if self._state != self.CLOSED:
+            self._set_state(self.CLOSED)
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+            self._failures = 0
+            self._set_state(self.OPEN)
+
+
+def _park_label(api, *args, **kwargs) -> dict:
+    return {"park": api.park_id}
+
 
 class YandexTaxiAPI:
-    def __init__(self, park_id: str, clid: str, api_key: str):
+    """Fleet API client for one park.
+
+    Holds a single pooled httpx.AsyncClient, so connections to fleet-api.taxi.yandex.net
+    are reused across driver lookups and top-ups instead of being re-established per call.
+    Create one per park and call ``aclose()`` on shutdown.
+    """
+
+    def __init__(self, park_id: str, clid: str, api_key: str, *, max_connections: int = 10,
+                 max_keepalive_connections: int = 5, keepalive_expiry: float = 60.0,
+                 timeout: float = 30.0, connect_timeout: float = 10.0, http2: bool = True,
+                 retry_policy: RetryPolicy | None = None, retry_budget: RetryBudget | None = None,
+                 breaker: CircuitBreaker | None = None, max_in_flight: int = 8,
+                 global_limit: asyncio.Semaphore | None = None,
+                 api_base: str = "https://fleet-api.taxi.yandex.net"):
         self.park_id = park_id
         self.clid = clid
         self.api_key = api_key
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.retry_budget = retry_budget or RetryBudget()
+        self.breaker = breaker or CircuitBreaker(park_id)
+        # In-flight requests are capped per park, and across parks by the shared global_limit
+        self._limit = asyncio.Semaphore(max_in_flight)
+        self._global_limit = global_limit
+
+        self._client = httpx.AsyncClient(
+            http2=http2 and HTTP2_AVAILABLE,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+                keepalive_expiry=keepalive_expiry,
+            ),
+            timeout=httpx.Timeout(timeout, connect=connect_timeout),
+        )
 
-        self.driver_api_url = "https://fleet-api.taxi.yandex.net/v1/parks/driver-profiles/list"
-        self.topup_api_url = "https://fleet-api.taxi.yandex.net/v2/parks/driver-profiles/transactions"
+        api_base = api_base.rstrip("/")
+        self.driver_api_url = f"{api_base}/v1/parks/driver-profiles/list"
+        self.topup_api_url = f"{api_base}/v2/parks/driver-profiles/transactions"
 
         self.base_fields = {
             "driver_profile": ["id", "first_name", "last_name", "phones", "work_status"],
@@ -22,22 +226,70 @@ class YandexTaxiAPI:
             "current_status": ["status"],
         }
 
-    def _make_api_request(self, url: str, body: dict, headers: dict = None, retries: int = 3):
+    @timed(YANDEX_REQUEST_SECONDS, labels=_park_label)
+    async def _make_api_request(self, url: str, body: dict, headers: dict = None):
+        """POST with retries on timeouts, transport errors and RETRYABLE_STATUS answers.
+
+        Raises the last httpx error once attempts or the park's retry budget run out.
+        Only safe for calls that are idempotent: lookups, or top-ups carrying a stable
+        X-Idempotency-Token.
+        """
         headers = headers or {}
-        for attempt in range(retries):
+        policy = self.retry_policy
+        for attempt in range(policy.attempts):
+            retry_after = None
+            self.breaker.before_call()
             try:
-                resp = requests.post(url, headers=headers, json=body, timeout=30)
-                if not resp.ok:
+                resp = await self._post(url, headers, body)
+                if not resp.is_success:
                     logger.warning("Yandex API returned %s: %s", resp.status_code, resp.text)
                 resp.raise_for_status()
+                self.breaker.record_success()
                 return resp
-            except requests.RequestException as e:
-                logger.warning("Attempt %d Yandex request failed: %s", attempt + 1, e)
-                if attempt == retries - 1:
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code not in RETRYABLE_STATUS:
+                    # Yandex answered; the request itself was wrong
+                    self.breaker.record_success()
                     raise
+                retry_after = retry_after_seconds(e.response)
+                error = e
+            except httpx.TransportError as e:
+                error = e
+            except BaseException:
+                # Cancelled or unexpected: no verdict on Yandex, but free a half-open probe slot
+                self.breaker.release_probe()
+                raise
+            self.breaker.record_failure()
+            logger.warning("Attempt %d Yandex request failed: %s", attempt + 1, error)
+            if attempt == policy.attempts - 1:
+                raise error
+            delay = policy.delay(attempt, retry_after)
+            if delay is None:
+                logger.warning("Yandex asked park %s to retry after %.0fs; giving up", self.park_id, retry_after)
+                raise error
+            if not self.retry_budget.try_spend():
+                logger.warning("Retry budget exhausted for park %s", self.park_id)
+                raise error
+            await asyncio.sleep(delay)
         return None
 
-    def get_driver_by_callsign(self, callsign: str):
+    async def _post(self, url: str, headers: dict, body: dict) -> httpx.Response:
+        async with self._limit:
+            if self._global_limit is None:
+                return await self._client.post(url, headers=headers, json=body)
+            async with self._global_limit:
+                return await self._client.post(url, headers=headers, json=body)
+
+    async def aclose(self) -> None:
+        await self._client.aclose()
+
+    @timed(DRIVER_LOOKUP_SECONDS, labels=_park_label)
+    async def get_driver_by_callsign(self, callsign: str):
+        """Driver profile for ``callsign``; None only when Yandex answered with no such driver.
+
+        Failed requests (transport errors, error statuses, retries exhausted) raise, so a
+        caller can tell an outage from a callsign that really isn't in the park.
+        """
         if not callsign:
             return None
         body = {
@@ -51,26 +303,44 @@ class YandexTaxiAPI:
             "Content-Type": "application/json",
         }
         try:
-            resp = self._make_api_request(self.driver_api_url, body, headers=headers)
-            if not resp:
-                return None
+            resp = await self._make_api_request(self.driver_api_url, body, headers=headers)
             data = resp.json()
-            drivers = data.get("driver_profiles", []) or []
-            # prefer exact matching callsign in car
-            for d in drivers:
-                car = d.get("car") or {}
-                if (car.get("callsign") or "").strip().upper() == callsign.upper():
-                    return d
-            return drivers[0] if drivers else None
+        except CircuitOpenError:
+            raise
         except Exception as e:
             logger.error("get_driver_by_callsign error: %s", e)
-            return None
+            raise
+        drivers = data.get("driver_profiles", []) or []
+        # prefer exact matching callsign in car
+        for d in drivers:
+            car = d.get("car") or {}
+            if (car.get("callsign") or "").strip().upper() == callsign.upper():
+                return d
+        return drivers[0] if drivers else None
 
-    def topup_balance(self, driver_id: str, category_id: str, amount: float) -> bool:
+    async def list_driver_profiles(self, offset: int = 0, limit: int = 1000) -> dict:
+        """One page of the park's driver profiles: ``{"driver_profiles": [...], "total": N, ...}``."""
+        body = {
+            "fields": self.base_fields,
+            "query": {"park": {"id": self.park_id}},
+            "limit": limit,
+            "offset": offset,
+        }
         headers = {
             "X-API-Key": self.api_key,
             "X-Client-ID": self.clid,
-            "X-Idempotency-Token": str(uuid.uuid4()),
+            "Content-Type": "application/json",
+        }
+        resp = await self._make_api_request(self.driver_api_url, body, headers=headers)
+        return resp.json() if resp else {}
+
+    @timed(TOPUP_SECONDS, labels=_park_label)
+    async def topup_balance(self, driver_id: str, category_id: str, amount: float,
+                            idempotency_token: str | None = None) -> bool:
+        headers = {
+            "X-API-Key": self.api_key,
+            "X-Client-ID": self.clid,
+            "X-Idempotency-Token": idempotency_token or str(uuid.uuid4()),
             "Content-Type": "application/json",
         }
         body = {
@@ -83,8 +353,15 @@ class YandexTaxiAPI:
             "description": "Пополнение баланса через систему",
         }
         try:
-            resp = self._make_api_request(self.topup_api_url, body, headers=headers)
+            resp = await self._make_api_request(self.topup_api_url, body, headers=headers)
             return bool(resp and resp.status_code == 200)
+        except httpx.HTTPStatusError as e:
+            if _is_unknown_driver(e.response):
+                raise StaleDriverError(driver_id) from e
+            logger.error("topup_balance error: %s", e)
+            return False
+        except CircuitOpenError:
+            raise
         except Exception as e:
             logger.error("topup_balance error: %s", e)
             return False